@@ -0,0 +1,36 @@
+/*********************************************************************************************************************************************
+ * Map requests numbered in the browser (see data/generations.py).
+ *
+ * mapRequest.next is a clientside callback on the map's inputs.  It writes the mapRequest store with the inputs and the next number for
+ * the session, in the order the changes happened, and the server map callback runs off that store: the server refuses a request whose
+ * number is not above the newest one it has started.  Changes Dash batches into one call are compared input by input, so a year slider
+ * change that only follows a lasso selection is still skipped without depending on which input Dash lists first.
+ *********************************************************************************************************************************************/
+(function() {
+    var inputNames = ['yearSlider', 'measures', 'dateRangeInsideOutside', 'fixFilter', 'mapboxCenterStore'];
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        mapRequest: {
+            next: function(sessionID, yearSlider, measures, dateRangeInsideOutside, fixFilter, mapboxCenterStore, relayoutData, previous) {
+                if (!sessionID || yearSlider == null || mapboxCenterStore == null) {
+                    return window.dash_clientside.no_update;
+                }
+
+                var inputs = {yearSlider: yearSlider, measures: measures, dateRangeInsideOutside: dateRangeInsideOutside,
+                              fixFilter: fixFilter, mapboxCenterStore: mapboxCenterStore};
+                var current = previous && previous.session === sessionID ? previous : null;
+                var changed = inputNames.filter(function(name) {
+                    return !current || JSON.stringify(current.inputs[name]) !== JSON.stringify(inputs[name]);
+                });
+
+                var lasso = relayoutData && relayoutData.dragmode === 'lasso';
+                if (current && changed.length === 1 && changed[0] === 'yearSlider' && lasso &&
+                    (fixFilter === 'Mapbox' || fixFilter === 'Measures')) {
+                    return window.dash_clientside.no_update;
+                }
+
+                return {session: sessionID, generation: (current ? current.generation : 0) + 1, inputs: inputs};
+            }
+        }
+    });
+})();
@@ -0,0 +1,79 @@
+/*********************************************************************************************************************************************
+ * Download progress pushed from /progress/<uuid> (server-sent events, see data/dataProcess.py).
+ *
+ * progress.render is a clientside callback on a short browser-only interval: it shows the newest state the stream delivered and switches
+ * off the server side fallback interval while the stream is live.  When the stream cannot be opened (no EventSource, the server at its
+ * ProgressStreamsMax) or goes quiet, the fallback interval runs again and its state is shown instead.  States of the job that was showing
+ * when Download was pressed are ignored, so a previous export's 100% never ends the new one.
+ *********************************************************************************************************************************************/
+(function() {
+    var quietMillis = 25000;
+    var stream = {source: null, state: null, heard: 0, staleJob: null, clicks: 0};
+
+    function heard() {
+        stream.heard = Date.now();
+    }
+
+    function listen(sessionID) {
+        if (stream.source) {
+            stream.source.close();
+            stream.source = null;
+        }
+        stream.state = null;
+        stream.heard = 0;
+        if (!window.EventSource) {
+            return;
+        }
+
+        var source = new EventSource('/progress/' + encodeURIComponent(sessionID));
+        source.onmessage = function(event) {
+            heard();
+            var state = JSON.parse(event.data);
+            if (state.job === stream.staleJob) {
+                return;
+            }
+            stream.state = state;
+            if (state.finished) {
+                source.close();
+                stream.source = null;
+            }
+        };
+        source.addEventListener('keepalive', heard);
+        source.onerror = function() {
+            // CONNECTING: the browser retries by itself.  CLOSED: refused (e.g. 503), leave it to the fallback.
+            if (source.readyState === EventSource.CLOSED) {
+                stream.source = null;
+                stream.heard = 0;
+            }
+        };
+        stream.source = source;
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        progress: {
+            render: function(nIntervals, nClicks, fallback, sessionID) {
+                if (!nClicks || !sessionID) {
+                    return [null, true, true];
+                }
+
+                if (nClicks !== stream.clicks) {
+                    stream.clicks = nClicks;
+                    var showing = stream.state || fallback;
+                    stream.staleJob = showing ? showing.job : null;
+                    listen(sessionID);
+                }
+
+                var live = stream.source !== null && Date.now() - stream.heard < quietMillis;
+                var state = stream.state;
+                if ((!live || !state) && fallback && fallback.job !== stream.staleJob) {
+                    state = fallback;
+                }
+
+                if (!state) {
+                    return ['0% Completed', false, live];
+                }
+                return [state.text, state.finished, state.finished || live];
+            }
+        }
+    });
+})();
@@ -0,0 +1,67 @@
+#*********************************************************************************************************************************************
+# Output size and encode throughput of the export formats, on synthetic S3 Select records written into an in-memory multipart upload.
+#
+#   python -m benchmarks.exportFormats [records per year] [years]
+#*********************************************************************************************************************************************
+import io
+import sys
+import time
+
+import numpy as np
+
+from data.download import MultipartWriter, exportFormats
+
+
+class MemoryS3:
+
+    def __init__(self):
+        self.parts = {}
+        self.objects = {}
+
+    def create_multipart_upload(self,Bucket,Key):
+        return {'UploadId':Key}
+
+    def upload_part(self,Bucket,Key,UploadId,PartNumber,Body):
+        self.parts[(UploadId,PartNumber)] = Body
+        return {'ETag':str(PartNumber)}
+
+    def complete_multipart_upload(self,Bucket,Key,UploadId,MultipartUpload):
+        self.objects[Key] = b''.join(self.parts[(UploadId,part['PartNumber'])] for part in MultipartUpload['Parts'])
+
+
+def yearRecords(year,records,seed=0):
+    # Shaped like GHCN-Daily: a few thousand stations, mostly empty flags, DATA_VALUE in tenths.
+    rng = np.random.default_rng(seed+year)
+    stations = rng.integers(0,5000,records)
+    days = np.datetime64(f'{year}-01-01') + rng.integers(0,365,records).astype('timedelta64[D]')
+    elements = np.array(['TMAX','TMIN','PRCP','SNOW','SNWD'])[rng.integers(0,5,records)]
+    values = rng.integers(-400,600,records)
+    qualities = np.where(rng.random(records) < 0.02,'I','')
+    sources = np.array(['7','S','W','H'])[rng.integers(0,4,records)]
+    times = np.where(rng.random(records) < 0.3,'0700','')
+    lines = [f'USC00{station:06d},{str(day).replace("-","")},{element},{value},,{quality},{source},{time}\n'
+             for station, day, element, value, quality, source, time in zip(stations,days,elements,values,qualities,sources,times)]
+    return ''.join(lines).encode()
+
+
+if __name__ == '__main__':
+    records = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    years = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    spools = [yearRecords(year,records) for year in range(2000,2000+years)]
+    rawBytes = sum(len(spool) for spool in spools)
+
+    for name, exportFormat in exportFormats.items():
+        s3 = MemoryS3()
+        writer = MultipartWriter(s3,'benchmark',name)
+        encoder = exportFormat(writer)
+
+        start = time.perf_counter()
+        encoder.begin()
+        for spool in spools:
+            encoder.add(io.BytesIO(spool),len(spool))
+        encoder.finish()
+        writer.close()
+        elapsed = time.perf_counter() - start
+
+        size = len(s3.objects[name])
+        print(f'{name:>8}: {size/2**20:8.1f} MB  ({size/rawBytes*100:5.1f}% of csv)  {rawBytes/2**20/elapsed:7.1f} MB/s of records')
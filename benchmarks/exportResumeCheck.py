@@ -0,0 +1,152 @@
+#*********************************************************************************************************************************************
+# Check the download worker's failure paths against fakeredis and an in-memory S3: an export that fails in its first year or part way
+# through is retried into the same multipart upload and ends byte for byte equal to an export that never failed, without rescanning the
+# years it had finished; one that runs out of attempts or is cancelled aborts its upload and drops its checkpoint.
+#
+#   python -m benchmarks.exportResumeCheck          needs fakeredis
+#*********************************************************************************************************************************************
+import collections
+import gzip
+import logging
+import os
+
+import fakeredis
+from botocore.exceptions import ClientError
+
+# The module level client is never used here, but it is built at import.
+for name, value in [('RedisEndpoint','localhost'),('RedisPort','6379'),('RedisPassword','')]:
+    os.environ.setdefault(name,value)
+
+from data import downloadWorker, jobs
+from data.download import csvHeader, yearBytesKey
+
+
+yearBegin, yearEnd = 2000, 2005
+recordsPerYear = 60000
+eventBytes = 2**16
+
+
+def yearRecords(year):
+    return ''.join(f'US{n:09d},{year}0101,TMAX,{n%500},,,S,\n' for n in range(recordsPerYear)).encode()
+
+
+class Payload:
+
+    def __init__(self,data):
+        self.data = data
+
+    def __iter__(self):
+        for start in range(0,len(self.data),eventBytes):
+            yield {'Records':{'Payload':self.data[start:start+eventBytes]}}
+        yield {'End':{}}
+
+    def close(self):
+        pass
+
+
+class MemoryS3:
+
+    # S3 Select answers every year with yearRecords; selects of failYear raise AccessDenied while failures remain.
+    def __init__(self,failYear=None,failures=0):
+        self.failYear = failYear
+        self.failures = failures
+        self.selects = collections.Counter()
+        self.uploads = {}
+        self.created = 0
+        self.completed = {}
+        self.aborted = 0
+
+    def select_object_content(self,Key,**kwargs):
+        year = int(Key[len('csv/'):-len('.csv')])
+        if year == self.failYear and self.failures:
+            self.failures -= 1
+            raise ClientError({'Error':{'Code':'AccessDenied','Message':'injected'}},'SelectObjectContent')
+        self.selects[year] += 1
+        return {'Payload':Payload(yearRecords(year))}
+
+    def create_multipart_upload(self,Bucket,Key):
+        self.created += 1
+        uploadId = f'upload{self.created}'
+        self.uploads[uploadId] = {}
+        return {'UploadId':uploadId}
+
+    def upload_part(self,Bucket,Key,UploadId,PartNumber,Body):
+        self.uploads[UploadId][PartNumber] = Body
+        return {'ETag':f'{UploadId}-{PartNumber}'}
+
+    def list_parts(self,Bucket,Key,UploadId,MaxParts):
+        if UploadId not in self.uploads:
+            raise ClientError({'Error':{'Code':'NoSuchUpload','Message':''}},'ListParts')
+        return {'Parts':[]}
+
+    def complete_multipart_upload(self,Bucket,Key,UploadId,MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        self.completed[Key] = b''.join(parts[part['PartNumber']] for part in MultipartUpload['Parts'])
+
+    def abort_multipart_upload(self,Bucket,Key,UploadId):
+        del self.uploads[UploadId]
+        self.aborted += 1
+
+
+def exportSpec(exportFormat):
+    return {'stations':['US1'],'measures':['TMAX'],'yearBegin':yearBegin,'yearEnd':yearEnd,'format':exportFormat,'bucket':'bucket',
+            'object':f'export.{exportFormat}','awsKey':'key','awsSecretKey':'secret'}
+
+
+def runToEnd(s3,exportFormat,cancelAtYear=None):
+    # Enqueue one job and let a worker take it (and its retries) until it finishes.
+    client = fakeredis.FakeRedis()
+    client.hset(yearBytesKey,mapping={year:1 for year in range(yearBegin,yearEnd+1)})
+    downloadWorker.s3Client = lambda awsKey, awsSecretKey: s3
+    spec = exportSpec(exportFormat)
+    jobId = jobs.enqueueJob(client,'session',spec)
+    leases = downloadWorker.LeaseKeeper(client)
+
+    heartbeat = jobs.heartbeat
+    def cancellingHeartbeat(client,jobId,sessionID,progress=None):
+        if cancelAtYear is not None and (progress or {}).get('year') == cancelAtYear:
+            jobs.cancelJob(client,jobId)
+        heartbeat(client,jobId,sessionID,progress)
+    downloadWorker.heartbeat = cancellingHeartbeat
+
+    try:
+        while jobs.jobState(client,jobId)['status'] not in jobs.finishedStatuses:
+            claimed = jobs.claimJob(client,timeout=1)
+            if claimed is not None:
+                downloadWorker.runJob(client,leases,*claimed)
+    finally:
+        downloadWorker.heartbeat = heartbeat
+    return jobs.jobState(client,jobId), jobs.loadCheckpoint(client,spec), s3.completed.get(spec['object'])
+
+
+def contents(data,exportFormat):
+    return gzip.decompress(data) if exportFormat == 'csv.gz' else data
+
+
+if __name__ == '__main__':
+    # The worker logs every injected failure with its traceback.
+    logging.disable(logging.ERROR)
+    expected = csvHeader + b''.join(yearRecords(year) for year in range(yearBegin,yearEnd+1))
+
+    for exportFormat in ['csv','csv.gz']:
+        for failYear, label in [(yearBegin,'first year'),(yearBegin+3,'part way')]:
+            s3 = MemoryS3(failYear,failures=jobs.jobAttempts-1)
+            state, checkpoint, data = runToEnd(s3,exportFormat)
+            assert state['status'] == 'done' and contents(data,exportFormat) == expected, f'{exportFormat}, failed {label}'
+            assert s3.created == 1 and not s3.uploads, f'{exportFormat}, failed {label}: {s3.created} uploads, {len(s3.uploads)} open'
+            # Years after the failure may have been scanned ahead on every attempt; the ones before it are never scanned again.
+            assert all(s3.selects[year] == 1 for year in range(yearBegin,failYear)), f'years rescanned: {dict(s3.selects)}'
+            assert checkpoint is None
+            print(f'{exportFormat:>6}, failed {label} {jobs.jobAttempts-1} times: one upload, {len(data)} bytes as expected')
+
+        s3 = MemoryS3(yearBegin+2,failures=jobs.jobAttempts)
+        state, checkpoint, data = runToEnd(s3,exportFormat)
+        assert state['status'] == 'failed' and data is None and checkpoint is None
+        assert s3.created == 1 and s3.aborted == 1 and not s3.uploads, f'{s3.created} uploads, {s3.aborted} aborted'
+        print(f'{exportFormat:>6}, out of attempts: the upload is aborted and the checkpoint dropped')
+
+        s3 = MemoryS3()
+        state, checkpoint, data = runToEnd(s3,exportFormat,cancelAtYear=yearBegin+1)
+        assert state['status'] == 'cancelled' and data is None and checkpoint is None
+        assert s3.created == 1 and s3.aborted == 1 and not s3.uploads, f'{s3.created} uploads, {s3.aborted} aborted'
+        print(f'{exportFormat:>6}, cancelled: the upload is aborted and the checkpoint dropped')
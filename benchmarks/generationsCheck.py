@@ -0,0 +1,102 @@
+#*********************************************************************************************************************************************
+# Check the per-session generations and single-flight against fakeredis: an older request stops at its next check, its guarded session
+# write is refused once a newer one has started, a request numbered by the client is refused once a higher number has started, the skip
+# counts land in the stats, and concurrent identical computations run once.
+#
+#   python -m benchmarks.generationsCheck          needs fakeredis
+#*********************************************************************************************************************************************
+import os
+import threading
+import time
+
+import fakeredis
+
+# The module level clients are never used here, but they are built at import.
+for name, value in [('RedisEndpoint','localhost'),('RedisPort','6379'),('RedisPassword','')]:
+    os.environ.setdefault(name,value)
+
+from data.generations import Generations, SingleFlight, StaleGeneration
+from data.sessionStore import SessionStore
+
+
+def stale(generations,channel,sessionID,generation,step):
+    try:
+        generations.check(channel,sessionID,generation,step)
+    except StaleGeneration:
+        return True
+    return False
+
+
+if __name__ == '__main__':
+    client = fakeredis.FakeRedis()
+    generations = Generations(client)
+    store = SessionStore(client)
+
+    older = generations.begin('map','session1')
+    assert not stale(generations,'map','session1',older,'select')
+    newer = generations.begin('map','session1')
+    assert newer == older+1
+    assert stale(generations,'map','session1',older,'select')
+    assert not stale(generations,'map','session1',newer,'return')
+    assert generations.begin('map','session2') == 1 and generations.begin('yearSlider','session1') == 1
+    assert not stale(generations,'map','session1',newer,'return'), 'another session or channel moved this generation'
+    print('older generations stop at their next check')
+
+    # The newer request writes first; the older one finishing afterwards must not put its result over it.
+    assert store.set('mapbox','newer','session1',generations.guard('map','session1',newer))
+    assert not store.set('mapbox','older','session1',generations.guard('map','session1',older))
+    assert store.get('mapbox','session1') == 'newer'
+    print('guarded writes keep the newest result')
+
+    # Numbered by the client: a request the server starts after a newer one is refused, whatever order the threads run in.
+    assert generations.begin('map','session3',2) == 2
+    try:
+        generations.begin('map','session3',1)
+        raise AssertionError('an older client generation started after a newer one')
+    except StaleGeneration:
+        pass
+    assert not stale(generations,'map','session3',2,'select') and generations.begin('map','session3',5) == 5
+    assert not store.set('mapbox','older','session3',generations.guard('map','session3',2))
+    print('client numbered generations start only in order')
+
+    stats = generations.stats()
+    assert stats['map:started'] == 5 and stats['yearSlider:started'] == 1 and stats['map:skipped:select'] == 1
+    assert stats['map:skipped:begin'] == 1
+    print(f'stats: {stats}')
+
+    singleFlight = SingleFlight(client)
+    runs = []
+
+    def compute():
+        runs.append(1)
+        time.sleep(0.2)
+        return 'result'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(singleFlight.do(('result','hash'),compute))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(runs) == 1 and results == ['result']*8 and generations.stats()['coalesced'] == 7
+    assert singleFlight.do(('result','hash'),compute) == 'result' and len(runs) == 2, 'a finished call was reused'
+
+    def fail():
+        time.sleep(0.2)
+        raise ValueError('select failed')
+
+    errors = []
+
+    def failing():
+        try:
+            singleFlight.do(('result','failing'),fail)
+        except ValueError as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=failing) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 4 and len(set(map(id,errors))) == 1
+    print('single-flight runs concurrent identical computations once and shares their errors')
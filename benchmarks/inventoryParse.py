@@ -0,0 +1,66 @@
+#*********************************************************************************************************************************************
+# Compare the legacy read_csv / apply / split inventory parse against the fixed-width loader.
+#
+#   python -m benchmarks.inventoryParse [lines]
+#*********************************************************************************************************************************************
+import io
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from data.inventory import parseInventory
+
+
+measureNames = ['PRCP','SNOW','SNWD','TMAX','TMIN','TAVG','TOBS','WT01','WT03','WT16','DAPR','MDPR','EVAP','AWND','WDFG','PGTM']
+
+
+def syntheticInventory(lines=750000,seed=0):
+    rng = np.random.default_rng(seed)
+    measuresPerStation = 6
+    stations = lines // measuresPerStation + 1
+
+    stationIds = np.array([f'US{n:09d}' for n in range(stations)])
+    latitude = rng.uniform(-90,90,stations)
+    longitude = rng.uniform(-180,180,stations)
+
+    rows = []
+    for i in range(stations):
+        for measure in rng.choice(measureNames,measuresPerStation,replace=False):
+            begin = int(rng.integers(1763,2020))
+            end = int(rng.integers(begin,2021))
+            rows.append(f'{stationIds[i]:<11} {latitude[i]:8.4f} {longitude[i]:9.4f} {measure:<4} {begin:4d} {end:4d}\n')
+            if len(rows) == lines:
+                return ''.join(rows).encode()
+    return ''.join(rows).encode()
+
+
+def legacyParse(raw):
+    # Same work as dd.read_csv(...).compute() on the single inventory partition, followed by the old clean up.
+    inventory = pd.read_csv(io.BytesIO(raw),header=None,names=['Data'])
+    inventory['Data'] = inventory['Data'].apply(lambda x: ' '.join(x.split()))
+    inventory = inventory['Data'].str.split(' ',expand=True)
+    inventory.columns=['station','latitude','longitude','measure','begin','end']
+    inventory = inventory.astype({'latitude':'float64','longitude':'float64','begin':'int64', 'end':'int64'})
+    return inventory
+
+
+def timeIt(function,raw,repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(raw)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best,elapsed)
+    return best, result
+
+
+if __name__ == '__main__':
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 750000
+    raw = syntheticInventory(lines)
+
+    for name, function in [('legacy',legacyParse),('fixed-width',parseInventory)]:
+        seconds, df = timeIt(function,raw)
+        megabytes = df.memory_usage(deep=True).sum() / 2**20
+        print(f'{name:>12}: {seconds*1000:8.1f} ms  {megabytes:8.1f} MB  ({len(df)} rows)')
@@ -0,0 +1,91 @@
+#*********************************************************************************************************************************************
+# Check the download job queue against fakeredis: claiming under the per-session limit, progress and its pub/sub notices, cancelling a
+# queued and a running job, retries until the attempts run out, requeueing jobs whose worker stopped heartbeating, and checkpoints.
+#
+#   python -m benchmarks.jobQueueCheck          needs fakeredis
+#*********************************************************************************************************************************************
+import fakeredis
+
+from data import jobs
+
+
+def exportSpec(year,bucket='bucket'):
+    return {'stations':['US1','US2'],'measures':['TMAX'],'yearBegin':year,'yearEnd':year+1,'bucket':bucket,'object':'export.csv',
+            'awsKey':'key','awsSecretKey':'secret'}
+
+
+def notices(pubsub):
+    jobIds = []
+    while True:
+        message = pubsub.get_message(timeout=0.1)
+        if message is None:
+            return jobIds
+        if message['type'] == 'message':
+            jobIds.append(message['data'].decode())
+
+
+def status(client,jobId):
+    return jobs.jobState(client,jobId)['status']
+
+
+if __name__ == '__main__':
+    client = fakeredis.FakeRedis()
+    jobs.sessionJobLimit = 1
+    pubsub = client.pubsub()
+    pubsub.subscribe(jobs.progressChannel('sessionA'))
+    notices(pubsub)
+
+    first = jobs.enqueueJob(client,'sessionA',exportSpec(2000),scans=4)
+    second = jobs.enqueueJob(client,'sessionA',exportSpec(2010))
+    other = jobs.enqueueJob(client,'sessionB',exportSpec(2000))
+    assert notices(pubsub) == [first,second]
+    assert jobs.latestJob(client,'sessionA') == second and [job['id'] for job in jobs.listJobs(client,'sessionA')] == [first,second]
+
+    jobId, sessionID, spec = jobs.claimJob(client,timeout=1)
+    assert (jobId, sessionID, spec['yearBegin']) == (first,'sessionA',2000) and status(client,first) == 'running'
+    assert jobs.claimJob(client,timeout=1) is None, 'a second job of the session ran past the per-session limit'
+    assert status(client,second) == 'queued' and client.lrange(jobs.queueKey,0,-1)[0].decode() == second
+    assert jobs.claimJob(client,timeout=1)[0] == other
+    print('claims respect the per-session limit')
+
+    jobs.heartbeat(client,first,'sessionA',{'scansDone':1,'bytesScanned':100})
+    state = jobs.jobState(client,first)
+    assert (state['scansDone'], state['bytesScanned']) == ('1','100') and notices(pubsub) == [first]
+    print('heartbeats record progress and notify the session')
+
+    jobs.cancelJob(client,second)
+    assert status(client,second) == 'cancelled' and client.llen(jobs.queueKey) == 0 and client.get(jobs.specKey(second)) is None
+    jobs.cancelJob(client,first)
+    try:
+        jobs.heartbeat(client,first,'sessionA')
+        raise AssertionError('a running job did not see its cancel')
+    except jobs.JobCancelled:
+        jobs.finishJob(client,first,'cancelled')
+    assert status(client,first) == 'cancelled' and client.zscore(jobs.sessionRunningKey('sessionA'),first) is None
+    assert client.get(jobs.specKey(first)) is None and notices(pubsub) == [second,first]
+    print('cancelling queued and running jobs')
+
+    for _ in range(1,jobs.jobAttempts):
+        assert jobs.retryJob(client,other,'sessionB','throttled') and status(client,other) == 'queued'
+        assert jobs.claimJob(client,timeout=1)[0] == other
+    assert not jobs.retryJob(client,other,'sessionB','throttled')
+    state = jobs.jobState(client,other)
+    assert (state['status'], state['attempts'], state['error']) == ('failed',str(jobs.jobAttempts),'throttled')
+    assert client.llen(jobs.processingKey) == 0 and client.zcard(jobs.runningKey) == 0
+    print(f'retries stop after {jobs.jobAttempts} attempts')
+
+    orphan = jobs.enqueueJob(client,'sessionC',exportSpec(2005))
+    assert jobs.claimJob(client,timeout=1)[0] == orphan
+    assert jobs.requeueOrphans(client) == 0, 'a job with a live lease was requeued'
+    client.zadd(jobs.runningKey,{orphan:0})
+    assert jobs.requeueOrphans(client) == 1 and status(client,orphan) == 'queued'
+    assert client.llen(jobs.processingKey) == 0 and jobs.claimJob(client,timeout=1)[0] == orphan
+    print('jobs of a stopped worker are requeued')
+
+    spec = exportSpec(2005)
+    jobs.saveCheckpoint(client,spec,{'nextYear':2006,'parts':[{'PartNumber':1,'ETag':'a'}]})
+    assert jobs.loadCheckpoint(client,dict(spec,awsKey='other'))['nextYear'] == 2006, 'the checkpoint depends on the credentials'
+    assert jobs.loadCheckpoint(client,exportSpec(2005,bucket='elsewhere')) is None
+    jobs.clearCheckpoint(client,spec)
+    assert jobs.loadCheckpoint(client,spec) is None
+    print('checkpoints are keyed by the export, not the job')
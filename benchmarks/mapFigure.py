@@ -0,0 +1,59 @@
+#*********************************************************************************************************************************************
+# Build time, serialize time (PlotlyJSONEncoder, as Dash does) and payload size of the station map figure: go.Figure, the dict builder,
+# the dict builder with typed arrays, and a cached trace where only the layout is rebuilt.
+#
+#   python -m benchmarks.mapFigure [points ...]
+#*********************************************************************************************************************************************
+import json
+import sys
+
+import plotly.graph_objects as go
+from plotly.utils import PlotlyJSONEncoder
+
+from data import mapFigure
+from benchmarks.sessionCodec import bestOf, stationFrame
+
+
+def legacyFigure(frame):
+    fig = go.Figure(go.Scattermapbox(
+        lat=frame.latitude,
+        lon=frame.longitude,
+        mode='markers',
+        name = '',
+        marker=go.scattermapbox.Marker(size=2,color='red'),
+        text = frame['station'].astype(str),
+        hovertemplate ="station: %{text}",
+        selected = {'marker':{'color':'#39FF14','size':3}},
+    ))
+    fig.update_layout(mapFigure.mapLayout(39.1,-94.7,3,'token'))
+    return fig
+
+
+def serialize(figure):
+    return json.dumps(figure,cls=PlotlyJSONEncoder)
+
+
+def dictFigure(frame,typed=False):
+    mapFigure.typedArrays = typed
+    try:
+        return mapFigure.mapFigure(mapFigure.stationTrace(frame),39.1,-94.7,3,'token')
+    finally:
+        mapFigure.typedArrays = False
+
+
+if __name__ == '__main__':
+    sizes = [int(points) for points in sys.argv[1:]] or [10000,50000,120000]
+
+    for points in sizes:
+        frame = stationFrame(points)
+        trace = mapFigure.stationTrace(frame)
+        builders = [('go.Figure',legacyFigure),
+                    ('dict',dictFigure),
+                    ('dict typed',lambda frame: dictFigure(frame,True)),
+                    ('cached trace',lambda frame: mapFigure.mapFigure(trace,39.1,-94.7,3,'token'))]
+
+        print(f'{points} points')
+        for name, builder in builders:
+            buildSeconds, figure = bestOf(builder,frame,repeat=3)
+            serializeSeconds, payload = bestOf(serialize,figure,repeat=3)
+            print(f'{name:>14}: build {buildSeconds*1000:8.1f} ms  serialize {serializeSeconds*1000:8.1f} ms  {len(payload)/2**10:9.1f} KB')
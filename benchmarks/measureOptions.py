@@ -0,0 +1,40 @@
+#*********************************************************************************************************************************************
+# Measure option lists for a few viewports and year filters: FilterEngine.measureOptions (the measure pyramid) against selecting the rows
+# and listing their measures, with the predicate mask cache cleared before each run.
+#
+#   python -m benchmarks.measureOptions [lines]
+#*********************************************************************************************************************************************
+import sys
+
+from data.filterEngine import FilterEngine, FilterSpec
+from data.inventory import parseInventory
+from benchmarks.inventoryParse import syntheticInventory, timeIt
+
+
+viewports = [('world',None),
+             ('continent',(-125.0,24.0,-66.0,50.0)),
+             ('state',(-104.0,37.0,-95.0,41.0)),
+             ('city',(-95.0,39.0,-94.0,39.5))]
+
+yearFilters = [None,(1990,2000,'in'),(1950,2010,'out')]
+
+
+if __name__ == '__main__':
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 750000
+    engine = FilterEngine(parseInventory(syntheticInventory(lines)))
+
+    def rowsPath(spec):
+        engine.cache.clear()
+        return engine.measuresPresent(engine.select(spec))
+
+    def pyramidPath(spec):
+        engine.cache.clear()
+        return engine.measureOptions(spec)
+
+    for name, viewport in viewports:
+        for years in yearFilters:
+            spec = FilterSpec(None,years,viewport,None)
+            rowSeconds, expected = timeIt(rowsPath,spec,repeat=5)
+            pyramidSeconds, options = timeIt(pyramidPath,spec,repeat=5)
+            assert sorted(options) == sorted(expected)
+            print(f'{name:>9} {str(years):>20}: rows {rowSeconds*1000:7.2f} ms  pyramid {pyramidSeconds*1000:7.2f} ms  ({len(options)} measures)')
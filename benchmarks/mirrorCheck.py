@@ -0,0 +1,67 @@
+#*********************************************************************************************************************************************
+# Check the Parquet mirror against the CSV it was built from: ingest two years into a scratch mirror, then for random station / measure
+# sets compare mirrorSelect's records with the same rows filtered straight out of the year CSV.  Small row groups, so the row group
+# skipping is exercised.
+#
+#   python -m benchmarks.mirrorCheck [source firstYear]     source is a directory of {year}.csv (default: a synthetic two-year sample)
+#*********************************************************************************************************************************************
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+from data import parquetMirror
+from data.download import ScanTask
+from data.inventory import openSource
+
+
+elements = ['PRCP','SNOW','SNWD','TMAX','TMIN','TAVG']
+
+
+def syntheticYear(path,year,rows=200000,stations=3000,seed=0):
+    rng = random.Random(seed+year)
+    with open(path,'w') as f:
+        for _ in range(rows):
+            f.write(f'US{rng.randrange(stations):09d},{year}{rng.randint(1,12):02d}{rng.randint(1,28):02d},{rng.choice(elements)},'
+                    f'{rng.randint(-300,500)},{rng.choice(["","T"])},{rng.choice(["","I"])},{rng.choice(["7","S"])},'
+                    f'{rng.choice(["","0700"])}\n')
+
+
+def csvRecords(source,year,stations,measures):
+    with openSource(parquetMirror.yearSource(source,year)) as f:
+        lines = f.read().decode().splitlines(True)
+    return sorted(line for line in lines if line.split(',',1)[0] in stations and line.split(',',3)[2] in measures)
+
+
+if __name__ == '__main__':
+    scratch = tempfile.mkdtemp(prefix='ghcn-mirror-check-')
+    try:
+        if len(sys.argv) > 2:
+            source, firstYear = sys.argv[1], int(sys.argv[2])
+        else:
+            source, firstYear = os.path.join(scratch,'csv'), 2001
+            os.makedirs(source)
+            for year in (firstYear,firstYear+1):
+                syntheticYear(parquetMirror.yearSource(source,year),year)
+
+        mirror = os.path.join(scratch,'mirror')
+        parquetMirror.rowGroupRows = 2000
+        rng = random.Random(0)
+        for year in (firstYear,firstYear+1):
+            rows, yearElements = parquetMirror.ingestYear(source,year,mirror)
+            with openSource(parquetMirror.yearSource(source,year)) as f:
+                yearStations = sorted(set(line.split(b',',1)[0].decode() for line in f.read().splitlines()))
+
+            for stationCount in (1,25,400):
+                stations = rng.sample(yearStations,min(stationCount,len(yearStations)))
+                # One measure the mirror does not hold, to check that a missing element file is skipped.
+                measures = rng.sample(yearElements,min(2,len(yearElements))) + ['NONE']
+                _, spool, size = parquetMirror.mirrorSelect(ScanTask(year,stations,measures),mirror)
+                records = sorted(spool.read().decode().splitlines(True))
+                expected = csvRecords(source,year,set(stations),set(measures))
+                assert records == expected, f'{year} {stationCount} stations: {len(records)} records from the mirror, {len(expected)} in the csv'
+                print(f'{year} {stationCount:>4} stations {measures}: {len(records)} records match')
+            print(f'{year}: {rows} rows ingested, {len(yearElements)} elements')
+    finally:
+        shutil.rmtree(scratch,ignore_errors=True)
@@ -0,0 +1,56 @@
+#*********************************************************************************************************************************************
+# Encode / decode time and payload size of the session cache codec for the mapbox station frame.
+#
+#   python -m benchmarks.sessionCodec [stations]
+#*********************************************************************************************************************************************
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from data.sessionCodec import encode, decode
+
+
+def stationFrame(stations=120000,seed=0):
+    rng = np.random.default_rng(seed)
+    names = pd.Index([f'US{n:09d}' for n in range(stations)])
+    return pd.DataFrame({'station':pd.Categorical.from_codes(np.arange(stations),categories=names),
+                         'latitude':rng.uniform(-90,90,stations).astype(np.float32),
+                         'longitude':rng.uniform(-180,180,stations).astype(np.float32)})
+
+
+def legacyEncode(df):
+    inData = pa.serialize(df).to_buffer()
+    return len(inData), pa.compress(inData,asbytes=True)
+
+
+def legacyDecode(payload):
+    length, compressed = payload
+    return pa.deserialize(pa.decompress(compressed,decompressed_size=length))
+
+
+def bestOf(function,argument,repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(argument)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best,elapsed)
+    return best, result
+
+
+if __name__ == '__main__':
+    df = stationFrame(int(sys.argv[1]) if len(sys.argv) > 1 else 120000)
+
+    codecs = [(compression,lambda value, compression=compression: encode(value,compression),decode,len)
+              for compression in ['none','lz4','zstd']]
+    if hasattr(pa,'serialize'):
+        codecs.append(('pa.serialize',legacyEncode,legacyDecode,lambda payload: len(payload[1])))
+
+    for name, encoder, decoder, size in codecs:
+        encodeSeconds, payload = bestOf(encoder,df)
+        decodeSeconds, result = bestOf(decoder,payload)
+        assert len(result) == len(df)
+        print(f'{name:>12}: encode {encodeSeconds*1000:7.2f} ms  decode {decodeSeconds*1000:7.2f} ms  {size(payload)/2**10:9.1f} KB')
@@ -0,0 +1,83 @@
+#*********************************************************************************************************************************************
+# Check SessionStore against fakeredis: two stores (two app processes, each with its own L1) on one server, covering reads after the other
+# process wrote, versions after a key was evicted, the byte budget, guarded writes, the byte accounting under concurrent writers, and
+# report / reap.
+#
+#   python -m benchmarks.sessionStoreCheck          needs fakeredis
+#*********************************************************************************************************************************************
+import os
+import threading
+
+import fakeredis
+import numpy as np
+
+# The module level client is never used here, but it is built at import.
+for name, value in [('RedisEndpoint','localhost'),('RedisPort','6379'),('RedisPassword','')]:
+    os.environ.setdefault(name,value)
+
+from data.sessionStore import SessionStore, totalBytesKey
+
+
+def accountedBytes(client):
+    # sessionBytesTotal against the per-session key sizes it is meant to sum.
+    sizes = sum(int(size) for key in client.scan_iter('sessionKeys*') for size in client.hvals(key))
+    return int(client.get(totalBytesKey) or 0), sizes
+
+
+if __name__ == '__main__':
+    server = fakeredis.FakeServer()
+    first = SessionStore(fakeredis.FakeRedis(server=server))
+    second = SessionStore(fakeredis.FakeRedis(server=server))
+
+    first.set('mapbox','a','session1')
+    assert second.get('mapbox','session1') == 'a'
+    first.set('mapbox','b','session1')
+    assert second.get('mapbox','session1') == 'b', 'L1 served a value the other store had replaced'
+    assert second.getMany(['mapbox','missing'],'session1') == {'mapbox':'b','missing':None}
+    print('reads see the other store\'s writes')
+
+    # The value and its version go (eviction, expiry), then the key is written again by the other store: the reader's L1 copy must not
+    # match the new version.
+    first.set('selection',{'years':[1970,2020]},'session2')
+    assert second.get('selection','session2') == {'years':[1970,2020]}
+    key = SessionStore.key('selection','session2')
+    first.client.delete(key,SessionStore.versionKey(key))
+    first.set('selection',{'years':[1990,2000]},'session2')
+    assert second.get('selection','session2') == {'years':[1990,2000]}, 'L1 matched a reused version'
+    print('versions are not reused after a key is deleted')
+
+    small = SessionStore(fakeredis.FakeRedis(server=server),byteBudget=3000)
+    small.set('large',np.zeros(200).tobytes(),'session3')
+    small.set('medium',np.zeros(100).tobytes(),'session3')
+    small.set('newest',np.zeros(150).tobytes(),'session3')
+    assert small.get('large','session3') is None and small.get('medium','session3') is not None
+    assert small.get('newest','session3') is not None
+    print('over budget evicts the largest other key')
+
+    guardKey = 'sessionGenerationmapsession4'
+    first.client.set(guardKey,2)
+    assert not first.set('mapbox','old','session4',guard=(guardKey,b'1'))
+    assert first.get('mapbox','session4') is None
+    assert first.set('mapbox','new','session4',guard=(guardKey,b'2'))
+    assert second.get('mapbox','session4') == 'new'
+    print('guarded writes')
+
+    def writer(store,seed):
+        rng = np.random.default_rng(seed)
+        for _ in range(200):
+            store.set(f'key{rng.integers(4)}',np.zeros(rng.integers(1,300)).tobytes(),'session5')
+
+    threads = [threading.Thread(target=writer,args=(store,seed)) for seed, store in enumerate([first,second,first,second])]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    total, sizes = accountedBytes(first.client)
+    assert total == sizes, f'sessionBytesTotal {total}, key sizes add up to {sizes}'
+    print(f'concurrent writers: {total} bytes accounted')
+
+    report = first.report()
+    assert report['totalBytes'] == total and report['sessions'] == 5
+    sessions, reclaimed = first.reap(now=float('inf'))
+    assert sessions == 5 and reclaimed == total and accountedBytes(first.client) == (0,0)
+    print(f'reap: {sessions} sessions, {reclaimed} bytes reclaimed')
@@ -1,26 +1,15 @@
 from app import app
 
 
-import numpy as np
 
-from dash.dependencies import Input, Output, State
-import plotly.graph_objects as go
-import dash
+from dash.dependencies import ClientsideFunction, Input, Output, State
 from dash.exceptions import PreventUpdate
 
-import redis
-
-import pyarrow as pa
-
 import os
 
-
-redis_host = os.environ['RedisEndpoint'] 
-redis_port = os.environ['RedisPort']
-password = os.environ['RedisPassword']
-redis = redis.StrictRedis(host = redis_host, port=redis_port,password = password)
-
-from data.dataProcess import getRedis
+from data.dataProcess import getMapTrace, sessionResult
+from data.mapFigure import mapFigure
+from data.generations import StaleGeneration, sessionGenerations
 
 mapbox_access_token = os.environ['MapboxToken']
 
@@ -35,61 +24,46 @@ def clearRelayoutdata(clearFiltersButton):
 
 
 
-@app.callback(Output('mapbox','figure'),
+app.clientside_callback(ClientsideFunction(namespace='mapRequest',function_name='next'),
+                    Output('mapRequest','data'),
                     [
-                    Input('mapboxCenterStore','data'),
-                    Input('dataProcessMapBox','children'),
                     Input('sessionStore','data'),
-                    ])  
-def mapbox(mapboxCenterStoreData,dataProcessDiv,sessionStoreData): 
-   
+                    Input('yearSlider','value'),
+                    Input('measures','value'),
+                    Input('dateRangeInsideOutside','value'),
+                    Input('fixFilter','value'),
+                    Input('mapboxCenterStore','data'),
+                    ],
+                    [State('mapbox','relayoutData'),
+                    State('mapRequest','data')])
 
 
-    
-
+@app.callback(Output('mapbox','figure'),
+                    [Input('mapRequest','data')])
+def mapbox(mapRequestData):
+    if mapRequestData is None:
+        raise PreventUpdate
+    sessionStoreData = mapRequestData['session']
+    inputs = mapRequestData['inputs']
+    mapboxCenterStoreData = inputs['mapboxCenterStore']
+
+    # The inputs and the generation were taken together in the browser (assets/mapRequest.js), so the generation orders requests as they
+    # were sent.  The result always comes from the inputs, so a map move that cancels a filter change still draws (and stores) the new
+    # filters; moving the map with unchanged filters finds the result cached and the session pointer already set.  A newer request from
+    # the session (the next step of a slider drag) makes this one stop at its next check.
+    try:
+        generation = sessionGenerations.begin('map',sessionStoreData,int(mapRequestData['generation']))
+        resultHash = sessionResult(sessionStoreData,inputs['measures'],inputs['yearSlider'],inputs['dateRangeInsideOutside'],generation)
+        sessionGenerations.check('map',sessionStoreData,generation,'trace')
+        trace = getMapTrace(sessionStoreData,mapboxCenterStoreData,resultHash)
+        sessionGenerations.check('map',sessionStoreData,generation,'return')
+    except StaleGeneration:
+        raise PreventUpdate
+    if trace is None:
+        raise PreventUpdate
 
-    uniqueStations = getRedis('mapbox',sessionStoreData)
-    
-    centerLon = mapboxCenterStoreData['centerLon']
-    centerLat = mapboxCenterStoreData['centerLat']
-    zoom = mapboxCenterStoreData['zoom']
-
-    fig = go.Figure(go.Scattermapbox(
-        lat=uniqueStations.latitude,
-        lon=uniqueStations.longitude,
-        mode='markers',
-        name = '',
-        marker=go.scattermapbox.Marker(
-            size=2,
-            color='red'
-        ),
-        text = uniqueStations['station'],
-        hovertemplate ="station: %{text}",
-        selected = {'marker':{'color':'#39FF14','size':3}},
-    
-    )
-                )
-
-    fig.update_layout(
-        autosize=False,
-        hovermode='closest',
-        # width = 1000,
-        #height = 600,
-        mapbox=dict(
-            accesstoken=mapbox_access_token,
-            bearing=0,
-            center=dict(
-            lat=centerLat,
-            lon=centerLon
-            ),
-            pitch=0,
-            zoom=zoom,
-            style = 'dark'
-
-        ),
-        margin={"r":0,"t":0,"l":0,"b":0}
-
-    )
+    fig = mapFigure(trace,mapboxCenterStoreData['centerLat'],mapboxCenterStoreData['centerLon'],mapboxCenterStoreData['zoom'],
+                    mapbox_access_token)
     
     return fig
 
@@ -3,9 +3,6 @@ import dash
 from dash.dependencies import Input, Output, State
 #import plotly.express as px
 from dash.exceptions import PreventUpdate
-from data.dataProcess import getRedis
-import redis
-import pyarrow as pa
 
 
 import io
@@ -15,51 +12,6 @@ import io
 import os
 
 
-redis_host = os.environ['RedisEndpoint'] 
-redis_port = os.environ['RedisPort']
-password = os.environ['RedisPassword']
-redis = redis.StrictRedis(host = redis_host, port=redis_port,password = password)
-
-
-@app.callback(Output('measures','options'),
-            [
-            Input('dataProcessMeasure','children'),
-            Input('sessionStore','data'),             
-            ])
-def measure(dataProcessMeasure,sessionStoreData): 
-   
-    return getRedis('measureOptions',sessionStoreData)
-
-
-@app.callback(Output('measures','value'),
-            [
-            Input('dataProcessMeasureValue','children'),
-            Input('sessionStore','data')       
-            ])
-def measure(dataProcessMeasureValue,sessionStoreData): 
-        return getRedis('measureValue',sessionStoreData)
-
-
-
-
-
-@app.callback([Output('yearSlider','min'),Output('yearSlider','max'),
-                Output('yearSlider','value'),Output('yearSlider','marks'),
-                ],
-            [
-            Input('dataProcessYearSlider','children'),
-            Input('sessionStore','data')        
-            ])
-def measure(dataProcessYearSlider,sessionStoreData):
-
-
-        return (getRedis('sliderValue',sessionStoreData)['min'], 
-        getRedis('sliderValue',sessionStoreData)['max'], 
-        getRedis('sliderValue',sessionStoreData)['value'],
-        getRedis('sliderValue',sessionStoreData)['marks'],
-        )
-
-
 #*********************************************************************************************************************************************
 # Hide / unhide download data Div  
 #********************************************************************************************************************************************
@@ -4,102 +4,134 @@
 from app import app
 
 import pandas as pd
-import dask
-import dask.dataframe as dd
 # from dask.distributed import Client
 # from dask import delayed
 
 import dash
-from dash.dependencies import Input, Output, State
+import flask
+from dash.dependencies import ClientsideFunction, Input, Output, State
 from dash.exceptions import PreventUpdate
 
 
-import numpy as np
-
-import pyarrow as pa
-
+import json
+import math
+import threading
+import time
 import uuid
-import redis
 
 import os 
 
-import io
-import boto3
-import s3fs
+from data.inventory import inventorySource, loadInventory
+from data.filterEngine import FilterEngine
+from data.spatialIndex import clusterStations, viewportFromCoordinates
+from data.mapFigure import TraceCache, clusterTrace, stationTrace
+from data.generations import StaleGeneration, sessionGenerations, singleFlight
+from data.sessionStore import sessionCache
+from data.resultCache import ResultCache, resultKey
+from data.download import cachedYearBytes, exportObjectName, planExport, plannedBytes, s3Client, streamExport
+from data.jobs import cancelJob, enqueueJob, jobState, latestJob, progressChannel
 
 
 #*********************************************************************************************************************************************
-# Connect to redis server
+# Shared session cache (one pooled Redis client for every module) and the cross-session filter result cache
 #*********************************************************************************************************************************************
-redis_host = os.environ['RedisEndpoint'] 
-redis_port = os.environ['RedisPort']
-password = os.environ['RedisPassword']
-redis = redis.StrictRedis(host = redis_host, port=redis_port,password = password)
 
+resultCache = ResultCache(sessionCache.client,l1=sessionCache.l1)
 
+clusterZoom = float(os.environ.get('MapClusterZoom',5))
+clusterPixels = int(os.environ.get('MapClusterPixels',24))
+viewportPadding = 0.5
 
-def setRedis(keyname,data,sessionID):
-    inData = pa.serialize(data).to_buffer()
-    compressLength = len(inData)
-    inDataCompress= pa.compress(inData,asbytes=True)
-    inDataDict = {'compressLength':compressLength,'inDataCompress':inDataCompress}
-    keyDict = {'key':f"{keyname}Cache{sessionID}"}
-    redis.hmset(keyDict['key'],inDataDict)
+mapTraces = TraceCache()
 
 def getRedis(keyname,sessionID):
+    return sessionCache.get(keyname,sessionID)
 
-    keyDict = {'key':f"{keyname}Cache{sessionID}"}
-
-    cacheDataCompress = redis.hget(keyDict['key'],'inDataCompress')
-    cacheDataLen = int(redis.hget(keyDict['key'],'compressLength'))
-    cacheSerialize = pa.decompress(cacheDataCompress,decompressed_size=cacheDataLen)
-    cache = pa.deserialize(cacheSerialize)
-    return cache
-
-@dask.delayed
-def filter_by_mapbox_data(dataFrame,relayoutData,selectedData):
-    df = dataFrame
-
-    if  relayoutData.get('dragmode') == 'pan':
-        df = df 
-    elif relayoutData.get('dragmode') is not None and selectedData is not None:  
-        stationList = []
-        for i in selectedData['points']:
-            stationList.append(i['text'])
-        df = df.query('station.isin(@stationList)')
-    elif relayoutData != {'autosize': True} and relayoutData is not None and relayoutData.get('dragmode') is None:
-
-        array=np.array((relayoutData['mapbox._derived']['coordinates']))
-        minLon = array[:,0].min()
-        maxLon = array[:,0].max()
-        minLat = array[:,1].min()
-        maxLat = array[:,1].max()
-
-        df = df.query('@minLat <= latitude <= @maxLat & @minLon <= longitude <= @maxLon') 
-    
-    return df
+def getStationIndices(sessionID):
+    return resultCache.get(getRedis('mapbox',sessionID))
+
+def mapLevel(mapView):
+    # Level of detail for the map: below clusterZoom, one point per grid cell with its station count; from there in, only the stations
+    # in a padded copy of the viewport, snapped outward to a power of two degree grid so small pans keep the same box (and trace).
+    zoom = mapView.get('zoom') or 0
+    if zoom < clusterZoom:
+        return ('clusters',clusterCellSize(zoom))
+    if mapView.get('bounds') is None:
+        return ('stations',None)
+
+    west, south, east, north = mapView['bounds']
+    step = 2.0**math.ceil(math.log2(max(east-west,north-south,1e-3)*viewportPadding))
+    return ('stations',(math.floor(west/step-1)*step,max(-90.0,math.floor(south/step-1)*step),
+                        math.ceil(east/step+1)*step,min(90.0,math.ceil(north/step+1)*step)))
+
+def mapTrace(level,stationIndices):
+    kind, detail = level
+    if kind == 'clusters':
+        cells, latitude, longitude, counts = clusterStations(stations.latitude[stationIndices],stations.longitude[stationIndices],detail)
+        return clusterTrace(pd.DataFrame({'cellSize':detail,'cell':cells,'latitude':latitude,'longitude':longitude,'count':counts}))
+
+    if detail is not None:
+        inView = filterEngine.stationGrid.mask(filterEngine.stationGrid.queryBox(*detail))
+        stationIndices = stationIndices[inView[stationIndices]]
+    return stationTrace(stations.frame(stationIndices))
+
+def getMapTrace(sessionID,mapView,resultHash=None):
+    # Keyed by the filter result hash, so a session moving the map inside the same level of detail, or another session on the same
+    # filters, gets the already built trace.
+    if resultHash is None:
+        resultHash = getRedis('mapbox',sessionID)
+    if resultHash is None:
+        return None
+    level = mapLevel(mapView)
+
+    def build():
+        stationIndices = resultCache.get(resultHash)
+        return None if stationIndices is None else mapTrace(level,stationIndices)
+
+    return mapTraces.get((resultHash,level),lambda: singleFlight.do(('trace',resultHash,level),build))
+
+def clusterCellSize(zoom):
+    # About clusterPixels on screen: the world is 512 * 2**zoom pixels wide.  Whole zoom levels keep the cells stable while zooming.
+    return clusterPixels * 360 / (512 * 2**int(zoom))
+
+def exportSelection(sessionID,yearSliderValue,measuresValue,measuresOptions,relayoutData,selectedData):
+    # What an export covers: the session's map stations inside the current area, the chosen measures that are on offer, and the
+    # begin / end of every (station, measure) pair so the planner only scans each year for the stations active in it.
+    stationIndices = getStationIndices(sessionID)
+    if stationIndices is None or yearSliderValue is None:
+        return None
+    spec = filterEngine.spec(relayoutData=relayoutData,selectedData=selectedData)
+    selected = filterEngine.stationGrid.mask(filterEngine.select(spec,level='stations'))
+    exportIndices = stationIndices[selected[stationIndices]]
+
+    measureOptions = set([value['value'] for value in measuresOptions or []])
+    measuresValues = set(measuresValue or [])
+    measures = list(measureOptions.intersection(measuresValues))
+
+    return {'stations':list(stations.stations[exportIndices]),'measures':measures,
+            'activity':[column.tolist() for column in stations.activity(exportIndices,measures)],
+            'yearBegin':int(yearSliderValue[0]),'yearEnd':int(yearSliderValue[1])}
 
 
 
 
 
 #*********************************************************************************************************************************************
-#Load inventory file text file, compute as pandas, remove extraneous spaces, split into columns
+#Load inventory file text file as fixed width columns (categorical station and measure, float32 lat/lon, int16 years)
 #*********************************************************************************************************************************************
 
 if __name__ == 'dataProcess':
     client = Client()
 
-inventory = dd.read_csv('s3://noaa-ghcn-pds/ghcnd-inventory.txt',storage_options={'anon':True},
-                    header=None,names=['Data']).compute()
-
-inventory['Data'] = inventory['Data'].apply(lambda x: ' '.join(x.split()))
+inventory = loadInventory(inventorySource)
 
-inventory = inventory['Data'].str.split(' ',expand=True)
+#*********************************************************************************************************************************************
+# Station table, spatial and year indexes, and the cached filter masks shared by every callback
+#*********************************************************************************************************************************************
 
-inventory.columns=['station','latitude','longitude','measure','begin','end']
+filterEngine = FilterEngine(inventory)
 
-inventory = inventory.astype({'latitude':'float64','longitude':'float64','begin':'int64', 'end':'int64'})
+stations = filterEngine.stations
 
 #*********************************************************************************************************************************************
 # Create session ID and store
@@ -115,45 +147,28 @@ def sessionStore(sessionGenDiv):
 
 
 #*********************************************************************************************************************************************
-# Create dataframe for mapbox image.  Filtered by yearSlider and measures
+# Filter result for the map.  Sessions on the same filters share one cached result; the session only keeps its hash, which the exports
+# read later.  The map callback (callbacks/mapbox.py) builds its figure from it in the same request.
 #*********************************************************************************************************************************************
 
+def sessionResult(sessionID,measuresValue,yearSliderValue,dateRangeInsideOutsideValue,generation=None):
+    spec = filterEngine.spec(measures=measuresValue or [],yearRange=yearSliderValue,rangeMode=dateRangeInsideOutsideValue)
 
-@app.callback(Output('dataProcessMapBox','children'),
-                    [
-                        Input('sessionStore','data'),
-                        Input('yearSlider','value'),
-                        Input('measures','value'),
-                        Input('dateRangeInsideOutside','value'),
-                        Input('fixFilter','value')],
-                       [State('mapbox','relayoutData')
-
-                    ]
-                    )
-def dataProcess(sessionStoreData,yearSliderValue,measuresValue,dateRangeInsideOutsideValue,fixFilterValue,relayoutData):
-    ctx = dash.callback_context
-
-    if relayoutData.get('dragmode') == 'lasso' and ctx.triggered[0]['prop_id'].split('.')[0] == 'yearSlider' and fixFilterValue in ['Mapbox','Measures']:
-         raise PreventUpdate
-
-    if dateRangeInsideOutsideValue == 'in':
-        df = inventory.query('measure.isin(@measuresValue) &  begin <= @yearSliderValue[0] & end >= @yearSliderValue[1]')
-    elif dateRangeInsideOutsideValue == 'out':
-        df = inventory.query('measure.isin(@measuresValue) &  begin >= @yearSliderValue[0] & end <= @yearSliderValue[1]')
-    else:
-        df = inventory.query('measure.isin(@measuresValue) &  begin == @yearSliderValue[0] & end == @yearSliderValue[1]')
-
-    df = df[['station','latitude','longitude']]
-    df = df.drop_duplicates(subset='station',keep='first')
-
-
+    resultHash = resultKey(spec,'stations',filterEngine.version)
+    if not resultCache.exists(resultHash):
+        if generation is not None:
+            sessionGenerations.check('map',sessionID,generation,'select')
+        singleFlight.do(('result',resultHash),lambda: resultCache.put(resultHash,filterEngine.select(spec,level='stations')))
 
-
-    setRedis('mapbox',df,sessionStoreData)
-
-    ctx = dash.callback_context
-
-    return 'Computed'
+    # The session pointer is only written when the filters changed it; an older generation never overwrites the hash a newer one has
+    # stored.
+    if getRedis('mapbox',sessionID) == resultHash:
+        return resultHash
+    guard = None if generation is None else sessionGenerations.guard('map',sessionID,generation)
+    if not sessionCache.set('mapbox',resultHash,sessionID,guard):
+        sessionGenerations.skipped('map','write')
+        raise StaleGeneration('map')
+    return resultHash
 
 
 @app.callback(Output('mapboxCenterStore','data'),
@@ -172,14 +187,18 @@ def mapboxCenterCoords(relayoutData):
         centerLat = 39.106667
         zoom = 3
 
-    return {'centerLon':centerLon,'centerLat':centerLat,'zoom':zoom}
+    bounds = None
+    if relayoutData is not None and 'mapbox._derived' in relayoutData:
+        bounds = [float(value) for value in viewportFromCoordinates(relayoutData['mapbox._derived']['coordinates'])]
+
+    return {'centerLon':centerLon,'centerLat':centerLat,'zoom':zoom,'bounds':bounds}
 
 #*********************************************************************************************************************************************
 # Create dictionary for measure callback options.  Filtered by yearSlider and mapbox relayout
 #*********************************************************************************************************************************************
 
 
-@app.callback(Output('dataProcessMeasure','children'),
+@app.callback(Output('measures','options'),
                    [
                         Input('sessionStore','data'),
                         Input('yearSlider','value'),
@@ -198,38 +217,28 @@ def dataProcess(sessionStoreData,yearSliderValue,relayoutData,selectedData,fixFi
 
     else:
 
-    
-        if yearSliderValue != [None,None]:
-
-            if dateRangeInsideOutsideValue == 'in':
-                measureInventory = inventory.query('begin <= @yearSliderValue[0] & end >= @yearSliderValue[1]')
-            elif dateRangeInsideOutsideValue == 'out':
-                measureInventory = inventory.query('begin >= @yearSliderValue[0] & end <= @yearSliderValue[1]')
-            else:
-                measureInventory = inventory.query('begin == @yearSliderValue[0] & end == @yearSliderValue[1]')
-
-        else:
-            measureInventory = inventory
-
-        measureInventory = filter_by_mapbox_data(measureInventory,relayoutData,selectedData)
-        finalMeasureInventory = measureInventory.compute()
-
-    measures = list(finalMeasureInventory.measure.unique())
+        generation = sessionGenerations.begin('measureOptions',sessionStoreData)
+        try:
+            sessionGenerations.check('measureOptions',sessionStoreData,generation,'select')
+            spec = filterEngine.spec(yearRange=yearSliderValue,rangeMode=dateRangeInsideOutsideValue,
+                                    relayoutData=relayoutData,selectedData=selectedData)
+            measures = filterEngine.measureOptions(spec)
+            sessionGenerations.check('measureOptions',sessionStoreData,generation,'return')
+        except StaleGeneration:
+            raise PreventUpdate
 
     options = []
     for measure in measures:
         optionDict = {'label':f'{measure}   ', 'value':measure}
         options.append(optionDict) 
 
-    setRedis('measureOptions',options,sessionStoreData)
-
-    return 'Computed'
+    return options
 
 #*********************************************************************************************************************************************
 # Create List for measure values to be supplied by buttons.  
 #*********************************************************************************************************************************************
 
-@app.callback(Output('dataProcessMeasureValue','children'),
+@app.callback(Output('measures','value'),
             [
             Input('sessionStore','data'),
             Input('measureChooseAll','n_clicks'),
@@ -244,7 +253,7 @@ def measureValue(sessionStoreData,chooseAll,chooseCore,chooseSelf,clearFiltersBu
 
     ctx = dash.callback_context
 
-    optionList = list(inventory.measure.unique())
+    optionList = filterEngine.allMeasures
     
     if ctx.triggered[0]['prop_id'].split('.')[0] == 'sessionStore' and clicks == 0:
         values =  optionList
@@ -259,15 +268,15 @@ def measureValue(sessionStoreData,chooseAll,chooseCore,chooseSelf,clearFiltersBu
     else:
         raise PreventUpdate
 
-    setRedis('measureValue',values,sessionStoreData)
-
-    return 'Computed'
+    return values
 
 #*********************************************************************************************************************************************
 # Create list of values and min, max for yearSlider.  Filtered by measure values and mapbox relayout
 #*********************************************************************************************************************************************
 
-@app.callback(Output('dataProcessYearSlider','children'),
+@app.callback([Output('yearSlider','min'),Output('yearSlider','max'),
+                Output('yearSlider','value'),Output('yearSlider','marks'),
+                ],
     
             [
             Input('sessionStore','data'),
@@ -276,34 +285,42 @@ def measureValue(sessionStoreData,chooseAll,chooseCore,chooseSelf,clearFiltersBu
             Input('measures','value'),
             Input('fixFilter','value'),
             Input('clearFiltersButton','n_clicks')
-            ]
+            ],
+            [State('yearSlider','value')]
             )
-def measureValue(sessionStoreData,relayoutData,selectedData,measuresValue,fixFilterValue,clearFiltersButton):
-    min = inventory.begin.min()
+def measureValue(sessionStoreData,relayoutData,selectedData,measuresValue,fixFilterValue,clearFiltersButton,yearSliderValue):
+    min = int(inventory.begin.min())
     
-    max = inventory.end.max()
+    max = int(inventory.end.max())
     startValue = 1970
 
     ctx = dash.callback_context
 
-    if ctx.triggered[0]['prop_id'].split('.')[0] == 'measures' and len(ctx.triggered)>1:
-        value = [startValue,max]
-    elif ctx.triggered[0]['prop_id'].split('.')[0] == 'clearFiltersButton':
-        value = [startValue,max]
-    elif fixFilterValue == 'Time':
+    reset = (yearSliderValue is None or
+             (ctx.triggered[0]['prop_id'].split('.')[0] == 'measures' and len(ctx.triggered)>1) or
+             ctx.triggered[0]['prop_id'].split('.')[0] == 'clearFiltersButton')
+    if not reset and fixFilterValue == 'Time':
         raise PreventUpdate
-    elif relayoutData.get('dragmode') == 'lasso' and selectedData is None:
+    elif not reset and relayoutData.get('dragmode') == 'lasso' and selectedData is None:
         raise PreventUpdate
 
-    else:
-    
+    # Only requests that produce a value start a generation (and so cancel the older one).
+    generation = sessionGenerations.begin('yearSlider',sessionStoreData)
 
-        df = inventory
+    if reset:
+        value = [startValue,max]
 
-        dd = filter_by_mapbox_data(df,relayoutData,selectedData)
-        df = dd.compute()
+    else:
 
-        value = [df.begin.min(),df.end.max()]
+        try:
+            sessionGenerations.check('yearSlider',sessionStoreData,generation,'select')
+            spec = filterEngine.spec(relayoutData=relayoutData,selectedData=selectedData)
+            value = filterEngine.yearBounds(filterEngine.select(spec))
+            sessionGenerations.check('yearSlider',sessionStoreData,generation,'return')
+        except StaleGeneration:
+            raise PreventUpdate
+        if value is None:
+            raise PreventUpdate
 
     markColor = '#EBEBEB'
     marks = {}
@@ -311,11 +328,7 @@ def measureValue(sessionStoreData,relayoutData,selectedData,measuresValue,fixFil
         marks.update({year:{'label':str(year),'style':{'color':markColor}}})
     marks.update({max:{'label':str(max),'style':{'color':markColor}}})
   
-    sliderDict = {'min':min,'max':max,'value':value,'marks':marks}
-
-    setRedis('sliderValue',sliderDict,sessionStoreData)  
-
-    return 'Computed'
+    return min, max, value, marks
 
 
 #*********************************************************************************************************************************************
@@ -335,6 +348,7 @@ def yearRange(yearSliderValue):
 @app.callback(Output('downloadSpinnerOutput','children'),
                        [
                         Input('startDownloadButton','n_clicks'),
+                        Input('cancelDownloadButton','n_clicks'),
                         Input('sessionStore','data')],
                         [State('yearSlider','value'),
                         State('measures','value'),
@@ -344,164 +358,213 @@ def yearRange(yearSliderValue):
                         State('inputAwsBucket','value'),
                         State('inputAwsObject','value'),
                         State('inputAwsKey','value'),
-                        State('inputAwsSecretKey','value')]
+                        State('inputAwsSecretKey','value'),
+                        State('exportFormat','value')]
                         
                     )
 
-def dataProcess(startDownloadButton,sessionStoreData,yearSliderValue,measuresValue,measuresOptions,relayoutData,selectedData,
-                inputAwsBucket,inputAwsObject,inputAwsKey,inputAwsSecretKey):
+def dataProcess(startDownloadButton,cancelDownloadButton,sessionStoreData,yearSliderValue,measuresValue,measuresOptions,relayoutData,selectedData,
+                inputAwsBucket,inputAwsObject,inputAwsKey,inputAwsSecretKey,exportFormat):
     
+    ctx = dash.callback_context
 
-    if startDownloadButton > 0:
+    if ctx.triggered[0]['prop_id'].split('.')[0] == 'cancelDownloadButton':
 
+        jobId = latestJob(sessionCache.client,sessionStoreData)
+        if jobId is not None:
+            cancelJob(sessionCache.client,jobId)
+        return ''
 
-        setRedis('downloadYear',yearSliderValue[0],sessionStoreData)
-        
-        uniqueStations = getRedis('mapbox',sessionStoreData)
-        dd = filter_by_mapbox_data(uniqueStations,relayoutData,selectedData)
-        uniqueStations = dd.compute()
-        uniqueStations = list(uniqueStations['station'])
-        stationText = ','.join(f''' '{station}' ''' for station in uniqueStations)
+    elif ctx.triggered[0]['prop_id'].split('.')[0] == 'startDownloadButton' and startDownloadButton > 0:
 
+        # Checked here rather than left to the worker, which would only fail the job DownloadJobAttempts times.
+        awsFields = [(field or '').strip() for field in [inputAwsBucket,inputAwsObject,inputAwsKey,inputAwsSecretKey]]
+        if not all(awsFields):
+            return 'Could not access the bucket.  Please enter the bucket, object name, key and secret key and try again'
+        inputAwsBucket, inputAwsObject, inputAwsKey, inputAwsSecretKey = awsFields
 
-        measureOptions = set([value['value'] for value in measuresOptions])
-        measuresValues = set(measuresValue)
-        measures = list(measureOptions.intersection(measuresValues))
-        readingText = ','.join(f''' '{reading}' ''' for reading in measures)
+        exportSpec = exportSelection(sessionStoreData,yearSliderValue,measuresValue,measuresOptions,relayoutData,selectedData)
+        if exportSpec is None:
+            raise PreventUpdate
 
-        yearBegin = yearSliderValue[0]
-        yearEnd = yearSliderValue[1]
-        
-        
-        
-        try:
-            s3 = boto3.client('s3',
-                        aws_access_key_id=inputAwsKey,
-                        aws_secret_access_key=inputAwsSecretKey)
+        exportSpec.update({'format':exportFormat,'bucket':inputAwsBucket,'object':exportObjectName(inputAwsObject,exportFormat),
+                           'awsKey':inputAwsKey,'awsSecretKey':inputAwsSecretKey})
 
-            fs = s3fs.S3FileSystem(key=inputAwsKey,
-                        secret=inputAwsSecretKey
-                        )
-            
+        # The export runs in a download worker (python -m data.downloadWorker); the request only queues it.
+        enqueueJob(sessionCache.client,sessionStoreData,exportSpec,scans=len(planExport(exportSpec)))
 
+        return ''
 
-            eventCount=1
 
-            for year in range(yearBegin,yearEnd+1):
 
-            
-                resp = s3.select_object_content(
-                    Bucket='noaa-ghcn-pds',
-                    Key=f'csv/{year}.csv',
-                    ExpressionType='SQL',
-                    Expression = f'''SELECT * FROM s3object s  WHERE s._1 IN ({stationText}) AND s._3 IN ({readingText})''',
-                    InputSerialization = {'CSV': {"FileHeaderInfo": "NONE"}, 'CompressionType': 'NONE'},
-                    OutputSerialization = {'CSV': {}}
-                    )
 
-                
 
-                for event in resp['Payload']:
-                    
-                    header = True
-                    if eventCount > 1:
-                        header = False
 
-                    if 'Records' in event:
-                        records =list(event['Records']['Payload'].decode('utf-8'))
-                        file_str = ''.join(r for r in records)
-        
-        
-                        df = pd.read_csv(io.StringIO(file_str),sep=',',names=['ID','YEAR_MONTH_DAY','ELEMENT',
-                                                                                'DATA_VALUE','M_FLAG','Q_FLAG','S_FLAG','OBS_TIME']) 
+#*********************************************************************************************************************************************
+# Direct download to the browser: the links carry a token that maps to the session, the selection is saved with every filter change,
+# and the route streams the export as a chunked response (no bucket and no credentials needed)
+#*********************************************************************************************************************************************
 
-                        userObject = f'{inputAwsObject}.csv'
-                        if inputAwsObject[-4:] == '.csv':
-                            userObject = inputAwsObject
+browserDownloadMaxBytes = int(os.environ.get('BrowserDownloadMaxBytes',2*1024**3))
+browserDownloadWorkers = int(os.environ.get('BrowserDownloadWorkers',4))
+# Each stream runs BrowserDownloadWorkers scans and spools up to twice that many in memory, on the server's credentials.
+browserDownloadStreams = threading.BoundedSemaphore(int(os.environ.get('BrowserDownloadStreamsMax',2)))
 
+def browserDownloadKey(token):
+    return f'browserDownload{token}'
 
-                        with fs.open(f's3://{inputAwsBucket}/{userObject}','a') as f:
-                            df.to_csv(f,index=False,header=header)
 
-                        eventCount = eventCount+1
+@app.callback([Output('downloadCSV','href'),Output('downloadCSVGzip','href')],
+                [Input('sessionStore','data'),
+                Input('yearSlider','value'),
+                Input('measures','value'),
+                Input('measures','options'),
+                Input('mapbox','relayoutData'),
+                Input('mapbox','selectedData')])
+def browserDownloadLinks(sessionStoreData,yearSliderValue,measuresValue,measuresOptions,relayoutData,selectedData):
+    if sessionStoreData is None:
+        raise PreventUpdate
 
-                setRedis('downloadYear',year,sessionStoreData)
-            
+    token = getRedis('browserDownloadToken',sessionStoreData)
+    if token is None:
+        token = uuid.uuid4().hex
+    sessionCache.client.set(browserDownloadKey(token),sessionStoreData,ex=sessionCache.ttl)
+    sessionCache.setMany({'browserDownloadToken':token,
+                          'browserDownloadSelection':{'yearSliderValue':yearSliderValue,'measuresValue':measuresValue,
+                                                      'measuresOptions':measuresOptions,'relayoutData':relayoutData,
+                                                      'selectedData':selectedData}},sessionStoreData)
 
+    return f'/download/{token}', f'/download/{token}?gzip=1'
 
-            return ''
 
-        
-        except:
-            return 'Could not access the bucket.  Please check credentials and try again'
+@app.server.route('/download/<token>')
+def browserDownload(token):
+    sessionID = sessionCache.client.get(browserDownloadKey(token))
+    if sessionID is None:
+        flask.abort(404)
+    sessionID = sessionID.decode()
 
+    selection = getRedis('browserDownloadSelection',sessionID)
+    spec = None if selection is None else exportSelection(sessionID,**selection)
+    if spec is None:
+        flask.abort(404)
 
+    # Served with the server's own AWS credentials (the default boto3 chain), so the cap is on what S3 Select would scan.
+    s3 = s3Client()
+    sizes = cachedYearBytes(sessionCache.client,s3)
+    if not sizes:
+        return flask.Response('The download size cannot be checked right now.  Please download to an AWS s3 bucket instead.',
+                              status=503,mimetype='text/plain')
+    if plannedBytes(planExport(spec),sizes) > browserDownloadMaxBytes:
+        return flask.Response('This selection is too large to stream to the browser.  Please download it to an AWS s3 bucket instead.',
+                              status=413,mimetype='text/plain')
 
+    if not browserDownloadStreams.acquire(blocking=False):
+        return flask.Response('Too many downloads are running right now.  Please try again shortly, or download to an AWS s3 bucket.',
+                              status=503,mimetype='text/plain')
+
+    compress = flask.request.args.get('gzip') == '1'
+    fileName = exportObjectName(f"ghcn-daily-{spec['yearBegin']}-{spec['yearEnd']}",'csv.gz' if compress else 'csv')
+    chunks = streamExport(s3,spec,compress,browserDownloadWorkers)
+    response = flask.Response(flask.stream_with_context(chunks),
+                              mimetype='application/gzip' if compress else 'text/csv',
+                              headers={'Content-Disposition':f'attachment; filename="{fileName}"','X-Accel-Buffering':'no'})
+    # Released when the response closes, finished or abandoned (as for the progress streams).
+    response.call_on_close(browserDownloadStreams.release)
+    return response
 
 
 
-@app.callback(Output('progressInterval','disabled'),
-            [Input('startDownloadButton','n_clicks'),
-            Input('progressDivInput','children')]
-             )
-def setInterval(n_clicks,progressDivInput):
-    ctx = dash.callback_context
-    if ctx.triggered[0]['prop_id'].split('.')[0] == 'startDownloadButton':
-        progress = 0
-    else:
-        progress = progressDivInput
-    
-    if n_clicks > 0 and (progressDivInput is None or progress != 100):
-        return False
-    else:
-        return True
 
 
+#*********************************************************************************************************************************************
+# Download progress: the worker keeps plain counters in the job hash and publishes on downloadProgress{uuid} after every scan.  The page
+# listens on /progress/<uuid> (server-sent events, assets/progress.js) and renders from a clientside tick; the server side interval
+# (ProgressFallbackSeconds) only runs while no stream is live, e.g. when ProgressStreamsMax streams are already open.
+#*********************************************************************************************************************************************
 
-@app.callback([Output('progressPercent','children'), Output('progressDivInput','children')],
+progressStreamSeconds = int(os.environ.get('ProgressStreamSeconds',300))
+progressKeepaliveSeconds = 10
+# Each open stream holds a Redis connection from the shared pool (RedisMaxConnections) for as long as it is open.
+progressStreams = threading.BoundedSemaphore(int(os.environ.get('ProgressStreamsMax',4)))
+
+
+def progressState(client,sessionID):
+    job = jobState(client,latestJob(client,sessionID))
+    if job is None:
+        return None
+
+    state = {'job':job['id'],'status':job['status'],'finished':job['status'] in ('done','failed','cancelled')}
+    if job['status'] == 'queued':
+        return dict(state,text=f"Queued: {job['scans']} scans planned",percent=0)
+    elif job['status'] == 'failed':
+        return dict(state,text=job.get('error'),percent=100)
+    elif job['status'] == 'cancelled':
+        return dict(state,text='Download cancelled',percent=100)
+
+    # Weighted by the bytes each scan reads, since a recent year's object is a hundred times an early one's.
+    bytesPlanned = int(job.get('bytesPlanned',0))
+    if bytesPlanned:
+        percent = int(job.get('bytesScanned',0))/bytesPlanned * 100
+    else:
+        percent = int(job['scansDone'])/max(1,int(job['scans'])) * 100
+    if job['status'] == 'done':
+        percent = 100
+    text = (f"{percent:.0f}% Completed ({job['scansDone']} of {job['scans']} scans, "
+            f"{int(job.get('bytesWritten',0))/2**20:.1f} MB written)")
+    return dict(state,text=text,percent=percent)
+
+
+@app.server.route('/progress/<sessionID>')
+def progressStream(sessionID):
+    if not progressStreams.acquire(blocking=False):
+        # The page falls back to polling.
+        return flask.Response('Too many progress streams',status=503,mimetype='text/plain')
+
+    client = sessionCache.client
+    pubsub = client.pubsub(ignore_subscribe_messages=True)
+
+    def events():
+        pubsub.subscribe(progressChannel(sessionID))
+        yield f'retry: {progressKeepaliveSeconds*1000}\n\n'
+        state = None
+        deadline = time.monotonic() + progressStreamSeconds
+        while time.monotonic() < deadline:
+            latest = progressState(client,sessionID)
+            if latest is not None and latest != state:
+                state = latest
+                yield f'data: {json.dumps(state)}\n\n'
+            else:
+                yield 'event: keepalive\ndata: 1\n\n'
+            # Woken by the worker's publish; otherwise the hash is read again every keepalive, in case a message was missed.
+            if pubsub.get_message(timeout=progressKeepaliveSeconds) is not None:
+                while pubsub.get_message() is not None:
+                    pass
+
+    def close():
+        pubsub.close()
+        progressStreams.release()
+
+    # call_on_close also runs when the client goes away before the first chunk, which a finally in events() would miss.
+    response = flask.Response(events(),mimetype='text/event-stream',headers={'Cache-Control':'no-cache','X-Accel-Buffering':'no'})
+    response.call_on_close(close)
+    return response
+
+
+app.clientside_callback(ClientsideFunction(namespace='progress',function_name='render'),
+                [Output('progressPercent','children'),
+                Output('progressInterval','disabled'),
+                Output('progressFallbackInterval','disabled')],
                 [Input('progressInterval','n_intervals'),
                 Input('startDownloadButton','n_clicks'),
-                Input('sessionStore','data')],
-                [State('yearSlider','value')])
-def progressUpdate(n_intervals,n_clicks,sessionStoreData,yearSliderValue):
-    if n_clicks > 0:
-        
-        try:
-           updateYear = getRedis('downloadYear',sessionStoreData)
-           yearRange = yearSliderValue[1]-yearSliderValue[0]
-           percentComplete = (updateYear-yearSliderValue[0])/yearRange * 100
-           return f'{percentComplete:.0f}% Completed', percentComplete
-        except:
-            return '0% Completed', 0  
-    else:
-        return None, None
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+                Input('progressFallback','data')],
+                [State('sessionStore','data')])
 
 
+@app.callback(Output('progressFallback','data'),
+                [Input('progressFallbackInterval','n_intervals')],
+                [State('sessionStore','data')])
+def progressFallback(n_intervals,sessionStoreData):
+    if sessionStoreData is None:
+        raise PreventUpdate
+    return progressState(sessionCache.client,sessionStoreData)
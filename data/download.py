@@ -0,0 +1,504 @@
+#*********************************************************************************************************************************************
+# Per-year S3 Select export.
+#
+# Each year of GHCN-Daily is its own csv/{year}.csv object, so the per-year selects are independent.  planExport turns an export into
+# ScanTasks: for every year only the stations with one of the measures active that year (from the inventory begin / end carried in the
+# spec), years with none are skipped, and station lists too long for one S3 Select expression are split.  runSelects runs the tasks on a
+# bounded thread pool, spools each task's records to a (spooled) temp file, and hands them back strictly in order.  Throttled requests are
+# retried with exponential backoff and jitter.  S3EndpointUrl points the client at a local S3 compatible stand-in (e.g. MinIO), and
+# ExportBackend=parquet answers the same tasks from the local Parquet mirror (data/parquetMirror.py) instead of S3 Select.
+#
+# The raw S3 Select CSV bytes are forwarded straight into one multipart upload of the destination object, either as they are or encoded
+# as gzip CSV or Parquet on the way, so memory stays bounded by the part size and one parsed block.  After each year the writer's state
+# (upload id, part ETags, unsent tail) can be checkpointed, and openExport picks an interrupted export back up at the first unfinished year.
+#*********************************************************************************************************************************************
+import collections
+import concurrent.futures
+import contextlib
+import gzip
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+import zlib
+
+import boto3
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+from botocore.exceptions import ClientError
+
+
+ghcnBucket = os.environ.get('GhcnBucket','noaa-ghcn-pds')
+s3EndpointUrl = os.environ.get('S3EndpointUrl')
+# 's3select' scans the public csv/{year}.csv objects; 'parquet' reads the local mirror built by python -m data.parquetMirror ingest.
+exportBackend = os.environ.get('ExportBackend','s3select')
+
+downloadWorkers = int(os.environ.get('DownloadWorkers',8))
+selectRetries = int(os.environ.get('SelectRetries',5))
+spoolBytes = int(os.environ.get('SelectSpoolBytes',16*2**20))
+partBytes = max(5*2**20,int(os.environ.get('UploadPartBytes',8*2**20)))
+copyBytes = 2**20
+# S3 Select rejects SQL expressions over 256 KB.
+expressionBytes = int(os.environ.get('SelectExpressionBytes',240*2**10))
+
+yearBytesKey = 'ghcnYearBytes'
+yearBytesTtl = 24*60*60
+
+throttleCodes = {'SlowDown','Throttling','ThrottlingException','RequestLimitExceeded','TooManyRequestsException',
+                 'ServiceUnavailable','InternalError','RequestTimeout'}
+
+csvColumns = ['ID','YEAR_MONTH_DAY','ELEMENT','DATA_VALUE','M_FLAG','Q_FLAG','S_FLAG','OBS_TIME']
+csvHeader = (','.join(csvColumns) + '\n').encode()
+
+csvTypes = {'ID':pa.string(),'YEAR_MONTH_DAY':pa.string(),'ELEMENT':pa.string(),'DATA_VALUE':pa.int32(),
+            'M_FLAG':pa.string(),'Q_FLAG':pa.string(),'S_FLAG':pa.string(),'OBS_TIME':pa.string()}
+parquetSchema = pa.schema([('ID',pa.dictionary(pa.int32(),pa.string())),
+                           ('DATE',pa.date32()),
+                           ('ELEMENT',pa.dictionary(pa.int32(),pa.string())),
+                           ('DATA_VALUE',pa.int32()),
+                           ('M_FLAG',pa.dictionary(pa.int32(),pa.string())),
+                           ('Q_FLAG',pa.dictionary(pa.int32(),pa.string())),
+                           ('S_FLAG',pa.dictionary(pa.int32(),pa.string())),
+                           ('OBS_TIME',pa.string())])
+
+gzipLevel = int(os.environ.get('ExportGzipLevel',6))
+parquetCompression = os.environ.get('ExportParquetCompression','zstd')
+parquetBlockBytes = int(os.environ.get('ExportParquetBlockBytes',16*2**20))
+
+ScanTask = collections.namedtuple('ScanTask',['year','stations','measures'])
+
+
+def s3Client(awsKey=None,awsSecretKey=None):
+    return boto3.client('s3',aws_access_key_id=awsKey,aws_secret_access_key=awsSecretKey,endpoint_url=s3EndpointUrl)
+
+
+def selectExpression(stations,measures):
+    stationText = ','.join(f''' '{station}' ''' for station in stations)
+    readingText = ','.join(f''' '{reading}' ''' for reading in measures)
+    return f'''SELECT * FROM s3object s  WHERE s._1 IN ({stationText}) AND s._3 IN ({readingText})'''
+
+
+#*********************************************************************************************************************************************
+# Planning
+#*********************************************************************************************************************************************
+
+def splitStations(stations,measures,maxBytes=expressionBytes):
+    budget = maxBytes - len(selectExpression([],measures))
+    chunk, chunkBytes = [], 0
+    for station in stations:
+        stationBytes = len(station) + 5
+        if chunk and chunkBytes + stationBytes > budget:
+            yield chunk
+            chunk, chunkBytes = [], 0
+        chunk.append(station)
+        chunkBytes += stationBytes
+    if chunk:
+        yield chunk
+
+
+def planExport(spec,maxBytes=expressionBytes):
+    stations = np.asarray(spec['stations'],dtype=object)
+    measures = np.asarray(spec['measures'],dtype=object)
+    tasks = []
+
+    if 'activity' not in spec:
+        # No begin / end for the pairs: every station in every year.
+        for year in range(spec['yearBegin'],spec['yearEnd']+1):
+            tasks.extend(ScanTask(year,chunk,list(measures)) for chunk in splitStations(list(stations),list(measures),maxBytes))
+        return tasks
+
+    stationPosition, measurePosition, begin, end = (np.asarray(column) for column in spec['activity'])
+    for year in range(spec['yearBegin'],spec['yearEnd']+1):
+        active = (begin <= year) & (end >= year)
+        if not active.any():
+            continue
+        yearMeasures = list(measures[np.unique(measurePosition[active])])
+        yearStations = list(stations[np.unique(stationPosition[active])])
+        tasks.extend(ScanTask(year,chunk,yearMeasures) for chunk in splitStations(yearStations,yearMeasures,maxBytes))
+    return tasks
+
+
+#*********************************************************************************************************************************************
+# Scanning
+#*********************************************************************************************************************************************
+
+def isThrottle(error):
+    # Errors in the middle of the event stream (EventStreamError) are ClientErrors too.
+    if isinstance(error,ClientError):
+        return error.response.get('Error',{}).get('Code') in throttleCodes
+    return False
+
+
+class ScanStopped(Exception):
+    pass
+
+
+def selectYear(s3,year,expression,retries=selectRetries,stop=None):
+    # stop (a threading.Event) ends the scan at its next event and closes the stream, so S3 stops scanning for an export nobody reads.
+    spool = tempfile.SpooledTemporaryFile(max_size=spoolBytes)
+
+    for attempt in range(retries+1):
+        try:
+            if stop is not None and stop.is_set():
+                raise ScanStopped(year)
+            resp = s3.select_object_content(
+                Bucket=ghcnBucket,
+                Key=f'csv/{year}.csv',
+                ExpressionType='SQL',
+                Expression=expression,
+                InputSerialization = {'CSV': {"FileHeaderInfo": "NONE"}, 'CompressionType': 'NONE'},
+                OutputSerialization = {'CSV': {}}
+                )
+            with contextlib.closing(resp['Payload']) as events:
+                for event in events:
+                    if stop is not None and stop.is_set():
+                        raise ScanStopped(year)
+                    if 'Records' in event:
+                        spool.write(event['Records']['Payload'])
+            break
+        except ClientError as error:
+            if attempt == retries or not isThrottle(error):
+                spool.close()
+                raise
+            # A partial stream may already be spooled; start the year over.
+            spool.seek(0)
+            spool.truncate()
+            delay = min(30,0.5 * 2**attempt) * (0.5 + random.random())
+            if stop is not None:
+                stop.wait(delay)
+            else:
+                time.sleep(delay)
+        except ScanStopped:
+            spool.close()
+            raise
+
+    size = spool.tell()
+    spool.seek(0)
+    return year, spool, size
+
+
+def yearObjectBytes(s3):
+    # Size of every csv/{year}.csv object.  S3 Select reads the whole object whatever the expression, so this is what a scan costs.
+    sizes = {}
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=ghcnBucket,Prefix='csv/'):
+        for item in page.get('Contents',[]):
+            name = item['Key'][len('csv/'):]
+            if name.endswith('.csv') and name[:-len('.csv')].isdigit():
+                sizes[int(name[:-len('.csv')])] = item['Size']
+    return sizes
+
+
+def cachedYearBytes(client,s3):
+    # yearObjectBytes, kept for a day in the ghcnYearBytes hash shared by the app and the workers.  Empty when the bucket cannot be
+    # listed.
+    sizes = client.hgetall(yearBytesKey)
+    if sizes:
+        return {int(year):int(size) for year, size in sizes.items()}
+    try:
+        sizes = yearObjectBytes(s3)
+    except Exception:
+        logging.exception('Could not list the year objects')
+        return {}
+    if sizes:
+        pipeline = client.pipeline(transaction=True)
+        pipeline.hset(yearBytesKey,mapping=sizes)
+        pipeline.expire(yearBytesKey,yearBytesTtl)
+        pipeline.execute()
+    return sizes
+
+
+def plannedBytes(tasks,sizes):
+    # What S3 Select will scan for the tasks; a year missing from the listing counts as the largest year listed.
+    largest = max(sizes.values())
+    return sum(sizes.get(task.year,largest) for task in tasks)
+
+
+def scanTask(s3,task,stop=None):
+    if exportBackend == 'parquet':
+        from data.parquetMirror import mirrorSelect
+        return mirrorSelect(task,stop=stop)
+    return selectYear(s3,task.year,selectExpression(task.stations,task.measures),stop=stop)
+
+
+def runSelects(s3,tasks,workers=downloadWorkers):
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1,workers))
+    pending = collections.deque()
+    nextTask = iter(tasks)
+    stop = threading.Event()
+
+    def submit():
+        task = next(nextTask,None)
+        if task is not None:
+            pending.append((task,executor.submit(scanTask,s3,task,stop)))
+
+    try:
+        # Keep at most two tasks in flight per worker, so spooled output stays bounded while results wait their turn.
+        for _ in range(2*max(1,workers)):
+            submit()
+        while pending:
+            task, future = pending.popleft()
+            year, spool, size = future.result()
+            submit()
+            try:
+                yield task, spool, size
+            finally:
+                spool.close()
+    finally:
+        # Closed early (a cancelled job, an abandoned browser download): queued scans never start and running ones stop at their next
+        # event rather than scanning to the end.
+        stop.set()
+        for task, future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+#*********************************************************************************************************************************************
+# Streaming multipart upload of the export
+#*********************************************************************************************************************************************
+
+class MultipartWriter:
+
+    # uploadId / parts / buffer / bytesWritten come from a checkpoint when an interrupted export is resumed.
+    def __init__(self,s3,bucket,key,partSize=partBytes,uploadId=None,parts=None,buffer=b'',bytesWritten=0):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.partSize = partSize
+        self.buffer = bytearray(buffer)
+        self.parts = list(parts or [])
+        self.bytesWritten = bytesWritten
+        if uploadId is None:
+            uploadId = s3.create_multipart_upload(Bucket=bucket,Key=key)['UploadId']
+        self.uploadId = uploadId
+
+    def write(self,data):
+        self.buffer += data
+        self.bytesWritten += len(data)
+        while len(self.buffer) >= self.partSize:
+            self.uploadPart(self.buffer[:self.partSize])
+            del self.buffer[:self.partSize]
+
+    def uploadPart(self,data):
+        partNumber = len(self.parts) + 1
+        resp = self.s3.upload_part(Bucket=self.bucket,Key=self.key,UploadId=self.uploadId,PartNumber=partNumber,Body=bytes(data))
+        self.parts.append({'PartNumber':partNumber,'ETag':resp['ETag']})
+
+    def close(self):
+        # The last part may be under the 5 MB minimum; an empty export still needs one (empty) part.
+        if self.buffer or not self.parts:
+            self.uploadPart(self.buffer)
+            self.buffer = bytearray()
+        self.s3.complete_multipart_upload(Bucket=self.bucket,Key=self.key,UploadId=self.uploadId,
+                                          MultipartUpload={'Parts':self.parts})
+
+    def abort(self):
+        self.s3.abort_multipart_upload(Bucket=self.bucket,Key=self.key,UploadId=self.uploadId)
+
+    def checkpoint(self):
+        # Everything needed to carry on with the same upload: uploaded part ETags plus the tail not yet big enough to be a part.
+        return {'uploadId':self.uploadId,'parts':self.parts,'buffer':bytes(self.buffer),'bytesWritten':self.bytesWritten}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,excType,excValue,traceback):
+        if excType is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+def copyRecords(records,writer):
+    while True:
+        chunk = records.read(copyBytes)
+        if not chunk:
+            break
+        writer.write(chunk)
+
+
+#*********************************************************************************************************************************************
+# Export formats
+#
+#   csv       the S3 Select records as they come, behind one header line
+#   csv.gz    the same text as a series of gzip members (one per scan), so it is still compressed as a stream and a year boundary is
+#             always a member boundary a resumed export can append to
+#   parquet   typed columns (date, int32 DATA_VALUE, dictionary encoded ID / ELEMENT / flags), one row group per parsed CSV block
+#
+# Parquet keeps its row group index in the footer, so a parquet export cannot be resumed from a checkpoint and starts over instead.
+#*********************************************************************************************************************************************
+
+class CsvFormat:
+
+    extension = '.csv'
+    resumable = True
+
+    def __init__(self,writer):
+        self.writer = writer
+
+    def begin(self):
+        self.writer.write(csvHeader)
+
+    def add(self,records,size):
+        copyRecords(records,self.writer)
+
+    def finish(self):
+        pass
+
+
+class GzipCsvFormat(CsvFormat):
+
+    extension = '.csv.gz'
+
+    def begin(self):
+        self.writer.write(gzip.compress(csvHeader))
+
+    def add(self,records,size):
+        if size == 0:
+            return
+        compressor = zlib.compressobj(gzipLevel,zlib.DEFLATED,31)
+        while True:
+            chunk = records.read(copyBytes)
+            if not chunk:
+                break
+            self.writer.write(compressor.compress(chunk))
+        self.writer.write(compressor.flush())
+
+
+class UploadSink:
+
+    # Just enough of a file object for pyarrow to write into a MultipartWriter.
+    def __init__(self,writer):
+        self.writer = writer
+        self.closed = False
+
+    def write(self,data):
+        self.writer.write(data)
+        return len(data)
+
+    def tell(self):
+        return self.writer.bytesWritten
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def writable(self):
+        return True
+
+
+class ParquetFormat:
+
+    extension = '.parquet'
+    resumable = False
+
+    def __init__(self,writer):
+        self.writer = writer
+        self.parquetWriter = None
+
+    def begin(self):
+        self.parquetWriter = pq.ParquetWriter(UploadSink(self.writer),parquetSchema,compression=parquetCompression)
+
+    def add(self,records,size):
+        if size == 0:
+            return
+        reader = pacsv.open_csv(records,
+                                read_options=pacsv.ReadOptions(column_names=csvColumns,block_size=parquetBlockBytes),
+                                convert_options=pacsv.ConvertOptions(column_types=csvTypes,strings_can_be_null=True))
+        for batch in reader:
+            self.parquetWriter.write_table(parquetTable(batch))
+
+    def finish(self):
+        self.parquetWriter.close()
+
+
+def parquetTable(batch):
+    date = pc.cast(pc.strptime(batch.column('YEAR_MONTH_DAY'),format='%Y%m%d',unit='s'),pa.date32())
+    columns = [batch.column('ID').dictionary_encode(),date,batch.column('ELEMENT').dictionary_encode(),batch.column('DATA_VALUE')]
+    columns += [batch.column(name).dictionary_encode() for name in ['M_FLAG','Q_FLAG','S_FLAG']]
+    columns.append(batch.column('OBS_TIME'))
+    return pa.Table.from_arrays(columns,schema=parquetSchema)
+
+
+exportFormats = {'csv':CsvFormat,'csv.gz':GzipCsvFormat,'parquet':ParquetFormat}
+
+
+def exportObjectName(name,exportFormat='csv'):
+    extension = exportFormats[exportFormat].extension
+    return name if name.endswith(extension) else f'{name}{extension}'
+
+
+#*********************************************************************************************************************************************
+# Whole export: every year of the spec into one object
+#*********************************************************************************************************************************************
+
+def openExport(s3,spec,checkpoint=None):
+    # Resume from a year boundary checkpoint when its upload still exists, otherwise start a new upload at the first year.
+    exportFormat = exportFormats[spec.get('format','csv')]
+    if checkpoint is not None and exportFormat.resumable:
+        try:
+            s3.list_parts(Bucket=spec['bucket'],Key=spec['object'],UploadId=checkpoint['uploadId'],MaxParts=1)
+            writer = MultipartWriter(s3,spec['bucket'],spec['object'],uploadId=checkpoint['uploadId'],parts=checkpoint['parts'],
+                                     buffer=checkpoint['buffer'],bytesWritten=checkpoint['bytesWritten'])
+            return writer, exportFormat(writer), checkpoint['nextYear']
+        except ClientError:
+            pass
+
+    writer = MultipartWriter(s3,spec['bucket'],spec['object'])
+    encoder = exportFormat(writer)
+    encoder.begin()
+    return writer, encoder, spec['yearBegin']
+
+
+def runExport(s3,spec,writer,encoder,nextYear,onYear=None,workers=downloadWorkers,tasks=None,onTask=None):
+    # The upload is left open on error so the export can be resumed; the caller decides when to abort it.  onYear runs once the last
+    # task of a year is written, i.e. at the boundaries a checkpoint can resume from; onTask runs after every task, for progress only.
+    if tasks is None:
+        tasks = planExport(spec)
+    tasks = [task for task in tasks if task.year >= nextYear]
+
+    with contextlib.closing(runSelects(s3,tasks,workers)) as selects:
+        for position, (task, records, size) in enumerate(selects):
+            encoder.add(records,size)
+            if onTask is not None:
+                onTask(task,writer)
+            if onYear is not None and (position+1 == len(tasks) or tasks[position+1].year != task.year):
+                onYear(task.year,writer)
+
+    encoder.finish()
+    writer.close()
+    return writer.bytesWritten
+
+
+#*********************************************************************************************************************************************
+# Straight to the browser
+#*********************************************************************************************************************************************
+
+def streamExport(s3,spec,compress=False,workers=downloadWorkers):
+    # Chunks of the export for a streamed HTTP response.  The response pulls one chunk at a time, and runSelects keeps at most two
+    # scans per worker in flight, so a slow client holds back the scans instead of piling output up in memory.
+    compressor = zlib.compressobj(gzipLevel,zlib.DEFLATED,31) if compress else None
+
+    def encode(data):
+        return compressor.compress(data) if compressor is not None else data
+
+    yield encode(csvHeader)
+    with contextlib.closing(runSelects(s3,planExport(spec),workers)) as selects:
+        for task, records, size in selects:
+            while True:
+                chunk = records.read(copyBytes)
+                if not chunk:
+                    break
+                chunk = encode(chunk)
+                if chunk:
+                    yield chunk
+
+    if compressor is not None:
+        yield compressor.flush()
@@ -0,0 +1,174 @@
+#*********************************************************************************************************************************************
+# Download worker process.
+#
+#   python -m data.downloadWorker
+#
+# Takes export jobs off the Redis queue (see data/jobs.py) and runs them outside the Dash request threads.  Each process runs
+# DownloadWorkerThreads jobs at most; DownloadJobsGlobal and DownloadJobsPerSession cap running jobs across all worker processes.
+# Exports are checkpointed when the upload opens and after every year, so a failed job is retried (DownloadJobAttempts) with the same
+# upload and a crashed one resumes from the first unfinished year instead of scanning every year again.  A job that is cancelled or runs
+# out of attempts aborts its upload and drops the checkpoint.
+#
+# Progress is weighted by bytes: every scan counts the size of the year object it reads (csv/{year}.csv, listed once a day into the
+# ghcnYearBytes hash), so a scan of 2019 weighs about a hundred times one of 1900.  The job hash is updated and its session's progress
+# channel published after every scan.
+#*********************************************************************************************************************************************
+import bisect
+import itertools
+import logging
+import os
+import threading
+import time
+
+from data.sessionStore import connectRedis
+from data.download import MultipartWriter, cachedYearBytes, openExport, planExport, runExport, s3Client
+from data.jobs import (JobCancelled, claimJob, clearCheckpoint, finishJob, globalJobLimit, heartbeat, jobLeaseSeconds,
+                       loadCheckpoint, queueKey, requeueOrphans, retryJob, saveCheckpoint)
+
+
+workerThreads = int(os.environ.get('DownloadWorkerThreads',globalJobLimit))
+
+accessError = 'Could not access the bucket.  Please check credentials and try again'
+
+
+class LeaseKeeper(threading.Thread):
+
+    # Refreshes the leases of this process's running jobs, since a single year's select can outlast a lease.
+    def __init__(self,client):
+        super().__init__(daemon=True)
+        self.client = client
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def add(self,jobId,sessionID):
+        with self.lock:
+            self.jobs[jobId] = sessionID
+
+    def remove(self,jobId):
+        with self.lock:
+            self.jobs.pop(jobId,None)
+
+    def run(self):
+        while True:
+            time.sleep(jobLeaseSeconds / 3)
+            with self.lock:
+                jobs = list(self.jobs.items())
+            for jobId, sessionID in jobs:
+                try:
+                    heartbeat(self.client,jobId,sessionID)
+                except JobCancelled:
+                    pass
+                except Exception:
+                    logging.exception('Could not refresh lease for job %s',jobId)
+
+
+def runJob(client,leases,jobId,sessionID,spec):
+    leases.add(jobId,sessionID)
+    s3 = s3Client(spec['awsKey'],spec['awsSecretKey'])
+    writer = encoder = None
+
+    tasks = planExport(spec)
+    taskYears = [task.year for task in tasks]
+    # Without the sizes (no list permission, a stand-in endpoint) every scan weighs the same.
+    sizes = cachedYearBytes(client,s3)
+    taskBytes = list(itertools.accumulate(sizes.get(task.year,1) for task in tasks))
+    progress = {'scansDone':0}
+
+    def bytesScanned(scans):
+        return taskBytes[scans-1] if scans else 0
+
+    def onTask(task,writer):
+        progress['scansDone'] += 1
+        heartbeat(client,jobId,sessionID,{'scansDone':progress['scansDone'],'bytesScanned':bytesScanned(progress['scansDone']),
+                                          'bytesWritten':writer.bytesWritten})
+
+    def onYear(year,writer):
+        # Checkpoint before reporting the year done, so a cancel or crash after this point never rescans the year.
+        if encoder.resumable:
+            saveCheckpoint(client,spec,dict(writer.checkpoint(),nextYear=year+1))
+        heartbeat(client,jobId,sessionID,{'year':year,'yearsDone':year-spec['yearBegin']+1})
+
+    try:
+        logging.info('Download job %s: %d scans planned over %d years',jobId,len(tasks),spec['yearEnd']-spec['yearBegin']+1)
+        heartbeat(client,jobId,sessionID,{'scans':len(tasks),'bytesPlanned':bytesScanned(len(tasks))})
+        writer, encoder, nextYear = openExport(s3,spec,loadCheckpoint(client,spec))
+        if encoder.resumable:
+            # Before any scan, so a retry after a failure in the first year carries on with this upload instead of opening another.
+            saveCheckpoint(client,spec,dict(writer.checkpoint(),nextYear=nextYear))
+        progress['scansDone'] = bisect.bisect_left(taskYears,nextYear)
+        if nextYear > spec['yearBegin']:
+            logging.info('Resuming download job %s at %d',jobId,nextYear)
+            heartbeat(client,jobId,sessionID,{'yearsDone':nextYear-spec['yearBegin'],'scansDone':progress['scansDone'],
+                                              'bytesScanned':bytesScanned(progress['scansDone']),'bytesWritten':writer.bytesWritten})
+        runExport(s3,spec,writer,encoder,nextYear,onYear,tasks=tasks,onTask=onTask)
+        clearCheckpoint(client,spec)
+        finishJob(client,jobId,'done',sessionID=sessionID)
+    except JobCancelled:
+        abortExport(client,s3,spec,writer)
+        finishJob(client,jobId,'cancelled',sessionID=sessionID)
+    except Exception:
+        logging.exception('Download job %s failed',jobId)
+        if encoder is not None and not encoder.resumable:
+            abortUpload(writer)
+        # Out of attempts: nothing will resume the upload, and an incomplete one is billed to the bucket owner until it is aborted.
+        if not retryJob(client,jobId,sessionID,accessError):
+            abortExport(client,s3,spec,writer)
+    finally:
+        leases.remove(jobId)
+
+
+def abortUpload(writer):
+    try:
+        writer.abort()
+    except Exception:
+        logging.exception('Could not abort upload %s',writer.uploadId)
+
+
+def abortExport(client,s3,spec,writer):
+    # The upload is this attempt's writer or, when the attempt failed before opening it, the one an earlier attempt checkpointed.
+    checkpoint = loadCheckpoint(client,spec)
+    if writer is None and checkpoint is not None:
+        writer = MultipartWriter(s3,spec['bucket'],spec['object'],uploadId=checkpoint['uploadId'])
+    if writer is not None:
+        abortUpload(writer)
+    clearCheckpoint(client,spec)
+
+
+def workLoop(client,leases):
+    while True:
+        try:
+            claimed = claimJob(client)
+        except Exception:
+            logging.exception('Could not claim a download job')
+            time.sleep(5)
+            continue
+
+        if claimed is None:
+            # Nothing claimable: either the queue is empty (claimJob already blocked) or every job is over a concurrency limit.
+            if client.llen(queueKey):
+                time.sleep(1)
+            continue
+
+        runJob(client,leases,*claimed)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    client = connectRedis()
+
+    requeued = requeueOrphans(client)
+    if requeued:
+        logging.info('Requeued %d orphaned download jobs',requeued)
+
+    leases = LeaseKeeper(client)
+    leases.start()
+
+    threads = [threading.Thread(target=workLoop,args=(client,leases),daemon=True) for _ in range(max(1,workerThreads))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+if __name__ == '__main__':
+    main()
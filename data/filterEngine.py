@@ -0,0 +1,197 @@
+#*********************************************************************************************************************************************
+# Filter engine shared by the map, measure option, year slider and download callbacks.
+#
+# A FilterSpec names the measures, the year range and range mode, the map viewport and the lasso selection.  Each predicate's mask is
+# kept in a bounded LRU keyed by that predicate's value, so moving one control recomputes one mask and ANDs it with the cached others.
+# Row level masks cover the long inventory, station level masks cover the station table.  Measure options for a viewport come from the
+# measure presence pyramid (data/measurePyramid.py) without selecting any rows.
+#*********************************************************************************************************************************************
+import collections
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+from data.stationTable import StationTable
+from data.spatialIndex import StationGrid, lassoPolygon, viewportFromCoordinates
+from data.intervalIndex import YearIntervalIndex
+from data.measurePyramid import MeasurePyramid
+
+
+FilterSpec = collections.namedtuple('FilterSpec',['measures','years','viewport','selection'])
+
+
+class FilterEngine:
+
+    def __init__(self,inventory,cacheSize=int(os.environ.get('FilterCacheSize',32))):
+        self.inventory = inventory
+        self.stations = StationTable(inventory)
+        self.stationGrid = StationGrid(self.stations.latitude,self.stations.longitude)
+        self.yearIndex = YearIntervalIndex(inventory.begin.values,inventory.end.values)
+
+        self.stationCodes = inventory.station.cat.codes.values
+        self.measureCodes = inventory.measure.cat.codes.values
+
+        # Measures in order of first appearance in the inventory (the order the checklist has always shown).
+        firstRows = np.unique(self.measureCodes,return_index=True)[1]
+        self.allMeasures = list(self.stations.measures[self.measureCodes[np.sort(firstRows)]])
+        self.measureRank = np.zeros(len(self.stations.measures),dtype=np.int64)
+        self.measureRank[self.measureCodes[np.sort(firstRows)]] = np.arange(len(firstRows))
+
+        self.measurePyramid = MeasurePyramid(inventory.latitude.values,inventory.longitude.values,self.measureCodes,
+                                             inventory.begin.values,inventory.end.values,len(self.stations.measures))
+
+        # Identifies this inventory for anything that stores indices into it outside the process.
+        version = hashlib.sha1()
+        version.update('\n'.join(self.stations.stations).encode())
+        version.update('\n'.join(self.stations.measures).encode())
+        for column in ['latitude','longitude','begin','end']:
+            version.update(np.ascontiguousarray(inventory[column].values).tobytes())
+        self.version = version.hexdigest()
+
+        self.cacheSize = cacheSize
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    #*****************************************************************************************************************************************
+    # Spec normalization
+    #*****************************************************************************************************************************************
+
+    def spec(self,measures=None,yearRange=None,rangeMode='in',relayoutData=None,selectedData=None):
+        if measures is not None:
+            measures = tuple(self.stations.measureCodes(measures))
+
+        years = None
+        if yearRange is not None and None not in yearRange:
+            years = (int(yearRange[0]),int(yearRange[1]),rangeMode)
+
+        viewport, selection = self.area(relayoutData,selectedData)
+        return FilterSpec(measures,years,viewport,selection)
+
+    def area(self,relayoutData,selectedData):
+        if relayoutData is None or relayoutData.get('dragmode') == 'pan':
+            return None, None
+        elif relayoutData.get('dragmode') is not None and selectedData is not None:
+            polygon = lassoPolygon(relayoutData,selectedData)
+            if polygon is not None:
+                return None, ('polygon',tuple(tuple(float(value) for value in vertex) for vertex in polygon))
+            # Station points carry their id as text; cluster points carry [cellSize, cell] and stand for every station in the cell.
+            points = selectedData['points']
+            indices = self.stations.stations.get_indexer([point['text'] for point in points if 'customdata' not in point])
+            indices = indices[indices >= 0]
+            clusters = collections.defaultdict(list)
+            for point in points:
+                if 'customdata' in point:
+                    clusters[float(point['customdata'][0])].append(int(point['customdata'][1]))
+            for cellSize, cells in clusters.items():
+                indices = np.concatenate([indices,self.stationGrid.queryCells(cellSize,cells)])
+            return None, ('stations',tuple(np.unique(indices).tolist()))
+        elif relayoutData != {'autosize': True} and relayoutData.get('dragmode') is None and 'mapbox._derived' in relayoutData:
+            return tuple(float(value) for value in viewportFromCoordinates(relayoutData['mapbox._derived']['coordinates'])), None
+        return None, None
+
+    #*****************************************************************************************************************************************
+    # Cached predicate masks
+    #*****************************************************************************************************************************************
+
+    def cached(self,key,compute):
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return self.cache[key]
+
+        mask = compute()
+        mask.flags.writeable = False
+
+        with self.lock:
+            self.misses += 1
+            self.cache[key] = mask
+            while len(self.cache) > self.cacheSize:
+                self.cache.popitem(last=False)
+        return mask
+
+    def measureRows(self,measures):
+        def compute():
+            lookup = np.zeros(len(self.stations.measures),dtype=bool)
+            lookup[list(measures)] = True
+            return lookup[self.measureCodes]
+        return self.cached(('measureRows',measures),compute)
+
+    def yearRows(self,years):
+        low, high, rangeMode = years
+        return self.cached(('yearRows',years),lambda: self.yearIndex.mask(self.yearIndex.query((low,high),rangeMode)))
+
+    def viewportStations(self,viewport):
+        return self.cached(('viewportStations',viewport),lambda: self.stationGrid.mask(self.stationGrid.queryBox(*viewport)))
+
+    def selectionStations(self,selection):
+        kind, value = selection
+        if kind == 'polygon':
+            compute = lambda: self.stationGrid.mask(self.stationGrid.queryPolygon(value))
+        else:
+            compute = lambda: self.stationGrid.mask(np.asarray(value,dtype=np.int64))
+        return self.cached(('selectionStations',selection),compute)
+
+    def measureYearStations(self,measures,years):
+        measureNames = list(self.stations.measures[list(measures)])
+        yearRange, rangeMode = (None, 'in') if years is None else (years[:2], years[2])
+        return self.cached(('measureYearStations',measures,years),lambda: self.stations.select(measureNames,yearRange,rangeMode))
+
+    def areaStations(self,spec):
+        masks = []
+        if spec.viewport is not None:
+            masks.append((('viewport',spec.viewport),self.viewportStations(spec.viewport)))
+        if spec.selection is not None:
+            masks.append((('selection',spec.selection),self.selectionStations(spec.selection)))
+        return masks
+
+    def areaRows(self,key,stationMask):
+        return self.cached(('areaRows',key),lambda: stationMask[self.stationCodes])
+
+    #*****************************************************************************************************************************************
+    # Entry point
+    #*****************************************************************************************************************************************
+
+    def select(self,spec,level='rows'):
+        if level == 'stations':
+            masks = [mask for key, mask in self.areaStations(spec)]
+            if spec.measures is not None:
+                masks.append(self.measureYearStations(spec.measures,spec.years))
+            size = len(self.stations)
+        else:
+            masks = [self.areaRows(key,mask) for key, mask in self.areaStations(spec)]
+            if spec.measures is not None:
+                masks.append(self.measureRows(spec.measures))
+            if spec.years is not None:
+                masks.append(self.yearRows(spec.years))
+            size = len(self.inventory)
+
+        if not masks:
+            return np.arange(size)
+
+        selected = masks[0] if len(masks) == 1 else np.logical_and.reduce(masks)
+        return np.flatnonzero(selected)
+
+    def measuresPresent(self,rows):
+        return self.measureNames(np.unique(self.measureCodes[rows]))
+
+    def measureNames(self,codes):
+        # In allMeasures order, so the checklist keeps its order as the viewport moves.
+        codes = np.asarray(codes,dtype=np.int64)
+        return list(self.stations.measures[codes[np.argsort(self.measureRank[codes],kind='stable')]])
+
+    def measureOptions(self,spec):
+        # Measures with a row in the spec's year range and area.  A viewport (or the whole map) is answered by the pyramid.  Lasso and
+        # station selections go through the rows, and so does 'equal', which the interval index answers with one short run of rows.
+        if spec.selection is not None or spec.measures is not None or (spec.years is not None and spec.years[2] == 'equal'):
+            return self.measuresPresent(self.select(spec))
+        return self.measureNames(self.measurePyramid.measureCodes(spec.viewport,spec.years))
+
+    def yearBounds(self,rows):
+        if len(rows) == 0:
+            return None
+        return [int(self.inventory.begin.values[rows].min()),int(self.inventory.end.values[rows].max())]
@@ -0,0 +1,126 @@
+#*********************************************************************************************************************************************
+# Per-session generations for the interactive callbacks, and single-flight for identical computations.
+#
+# Each callback channel (map, measure options, year slider) bumps sessionGeneration{channel}{uuid} when a request starts.  The map numbers
+# its requests in the browser (the mapRequest store, assets/mapRequest.js), in the order they were sent: a request is refused unless its
+# number is above the stored one, so one the server happens to start late never takes over from a newer one.  A request checks its generation before each expensive step and before it writes or returns; once a newer request from the same session has
+# started, the older one stops there, and writes into the session cache are guarded so an older generation can never land after a
+# newer one.  Started and skipped counts (by channel and step) go into the sessionGenerationStats hash; `python -m data.sessionAdmin
+# report` prints them.
+#
+# SingleFlight lets concurrent requests that need the same result (the same filter result hash, the same map trace) wait for one
+# computation instead of each running it.
+#*********************************************************************************************************************************************
+import threading
+
+import redis
+
+from data.sessionStore import sessionCache, sessionTtl
+
+
+statsKey = 'sessionGenerationStats'
+
+
+class StaleGeneration(Exception):
+    pass
+
+
+class Generations:
+
+    def __init__(self,client,ttl=sessionTtl):
+        self.client = client
+        self.ttl = ttl
+
+    @staticmethod
+    def key(channel,sessionID):
+        return f'sessionGeneration{channel}{sessionID}'
+
+    def begin(self,channel,sessionID,generation=None):
+        if generation is not None:
+            return self.advance(channel,sessionID,generation)
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.incr(self.key(channel,sessionID))
+        pipeline.expire(self.key(channel,sessionID),self.ttl)
+        pipeline.hincrby(statsKey,f'{channel}:started',1)
+        return pipeline.execute()[0]
+
+    def advance(self,channel,sessionID,generation):
+        # A generation numbered by the client: stored only if it is newer than the stored one (under WATCH, like the guarded writes),
+        # otherwise StaleGeneration.
+        key = self.key(channel,sessionID)
+        while True:
+            with self.client.pipeline(transaction=True) as pipeline:
+                pipeline.watch(key)
+                if int(pipeline.get(key) or 0) >= generation:
+                    break
+                pipeline.multi()
+                pipeline.set(key,generation,ex=self.ttl)
+                pipeline.hincrby(statsKey,f'{channel}:started',1)
+                try:
+                    pipeline.execute()
+                    return generation
+                except redis.WatchError:
+                    continue
+        self.skipped(channel,'begin')
+        raise StaleGeneration(channel)
+
+    def current(self,channel,sessionID,generation):
+        return self.client.get(self.key(channel,sessionID)) == self.value(generation)
+
+    def check(self,channel,sessionID,generation,step):
+        # Raises StaleGeneration (and counts the skipped step) once a newer request on this channel has started.
+        if not self.current(channel,sessionID,generation):
+            self.skipped(channel,step)
+            raise StaleGeneration(channel)
+
+    def skipped(self,channel,step):
+        self.client.hincrby(statsKey,f'{channel}:skipped:{step}',1)
+
+    def guard(self,channel,sessionID,generation):
+        # For SessionStore.set(..., guard=...): only write while this is still the newest generation.
+        return self.key(channel,sessionID), self.value(generation)
+
+    @staticmethod
+    def value(generation):
+        return str(generation).encode()
+
+    def stats(self):
+        return {field.decode():int(count) for field, count in self.client.hgetall(statsKey).items()}
+
+
+class SingleFlight:
+
+    def __init__(self,client=None):
+        self.client = client
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self,key,compute):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = {'done':threading.Event(),'result':None,'error':None}
+
+        if not leader:
+            call['done'].wait()
+            if self.client is not None:
+                self.client.hincrby(statsKey,'coalesced',1)
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = compute()
+            return call['result']
+        except Exception as error:
+            call['error'] = error
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call['done'].set()
+
+
+sessionGenerations = Generations(sessionCache.client)
+singleFlight = SingleFlight(sessionCache.client)
@@ -0,0 +1,73 @@
+#*********************************************************************************************************************************************
+# Interval index over the inventory's (begin, end) year ranges, built once at load time.
+#
+# Rows are kept in begin-sorted, end-sorted and (begin, end)-sorted permutations, so the three dateRangeInsideOutside modes are answered
+# with binary searches:
+#   'in'     station range includes the slider  (begin <= low & end >= high)
+#   'out'    slider includes the station range  (begin >= low & end <= high)
+#   'equal'  station range equals the slider    (begin == low & end == high)
+# 'equal' is a single contiguous run of the pair-sorted order.  'in' / 'out' take the smaller of the begin and end candidate runs and
+# check the other bound on it.  Results are sorted row positions so they intersect cheaply with other filters.
+#*********************************************************************************************************************************************
+import numpy as np
+
+
+class YearIntervalIndex:
+
+    def __init__(self,begin,end):
+        begin = np.asarray(begin)
+        end = np.asarray(end)
+        self.size = len(begin)
+        self.begin = begin
+        self.end = end
+
+        self.beginOrder = np.argsort(begin,kind='stable').astype(np.int32)
+        self.beginSorted = begin[self.beginOrder]
+        self.endOrder = np.argsort(end,kind='stable').astype(np.int32)
+        self.endSorted = end[self.endOrder]
+
+        pairs = self.pairKey(begin,end)
+        self.pairOrder = np.argsort(pairs,kind='stable').astype(np.int32)
+        self.pairSorted = pairs[self.pairOrder]
+
+    @staticmethod
+    def pairKey(begin,end):
+        return (np.asarray(begin,dtype=np.int32) << 16) | np.asarray(end,dtype=np.int32)
+
+    def beginAtMost(self,year):
+        return self.beginOrder[:np.searchsorted(self.beginSorted,year,side='right')]
+
+    def beginAtLeast(self,year):
+        return self.beginOrder[np.searchsorted(self.beginSorted,year,side='left'):]
+
+    def endAtMost(self,year):
+        return self.endOrder[:np.searchsorted(self.endSorted,year,side='right')]
+
+    def endAtLeast(self,year):
+        return self.endOrder[np.searchsorted(self.endSorted,year,side='left'):]
+
+    def query(self,yearRange,rangeMode='in'):
+        low, high = yearRange
+
+        if rangeMode == 'in':
+            byBegin, byEnd = self.beginAtMost(low), self.endAtLeast(high)
+            if len(byBegin) <= len(byEnd):
+                rows = byBegin[self.end[byBegin] >= high]
+            else:
+                rows = byEnd[self.begin[byEnd] <= low]
+        elif rangeMode == 'out':
+            byBegin, byEnd = self.beginAtLeast(low), self.endAtMost(high)
+            if len(byBegin) <= len(byEnd):
+                rows = byBegin[self.end[byBegin] <= high]
+            else:
+                rows = byEnd[self.begin[byEnd] >= low]
+        else:
+            key = self.pairKey(low,high)
+            rows = self.pairOrder[np.searchsorted(self.pairSorted,key,side='left'):np.searchsorted(self.pairSorted,key,side='right')]
+
+        return np.sort(rows)
+
+    def mask(self,rows):
+        selected = np.zeros(self.size,dtype=bool)
+        selected[rows] = True
+        return selected
@@ -0,0 +1,200 @@
+#*********************************************************************************************************************************************
+# Fixed-width loader for ghcnd-inventory.txt
+#
+# Every line of the inventory has the same layout (see the GHCN-Daily readme):
+#   ID 1-11, LATITUDE 13-20, LONGITUDE 22-30, ELEMENT 32-35, FIRSTYEAR 37-40, LASTYEAR 42-45
+# so the whole file can be viewed as a 2D byte array and every column cut out with one slice.
+#
+# The parsed frame is snapshotted to a local Arrow IPC (feather v2) file keyed by the source's ETag / size, so a restarted worker
+# memory maps the snapshot instead of fetching and parsing the inventory again.
+#*********************************************************************************************************************************************
+import glob
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import fsspec
+import pyarrow.feather as feather
+from botocore.exceptions import BotoCoreError
+
+
+inventorySource = os.environ.get('InventorySource','s3://noaa-ghcn-pds/ghcnd-inventory.txt')
+inventoryCacheDir = os.environ.get('InventoryCacheDir',os.path.join(tempfile.gettempdir(),'ghcn-inventory'))
+
+# Bump when the parsed layout changes so old snapshots are not reused.
+snapshotVersion = 1
+
+lineWidth = 45
+
+columnSlices = {'station':(0,11),
+                'latitude':(12,20),
+                'longitude':(21,30),
+                'measure':(31,35),
+                'begin':(36,40),
+                'end':(41,45)}
+
+
+def openSource(source,storageOptions=None):
+    if storageOptions is None and source.startswith('s3://'):
+        storageOptions = {'anon':True}
+    return fsspec.open(source,'rb',**(storageOptions or {}))
+
+
+def readInventoryBytes(source=inventorySource,storageOptions=None):
+    with openSource(source,storageOptions) as f:
+        return f.read()
+
+
+def inventoryCharArray(raw):
+    raw = raw.rstrip(b'\r\n') + b'\n'
+    chars = np.frombuffer(raw,dtype=np.uint8)
+
+    # Fast path: every line is exactly lineWidth characters plus '\n', so the buffer reshapes without a copy.
+    if len(chars) % (lineWidth+1) == 0:
+        chars = chars.reshape(-1,lineWidth+1)
+        if (chars[:,lineWidth] == ord('\n')).all():
+            return chars[:,:lineWidth]
+
+    # Ragged lines (trailing spaces, '\r\n'): pad / truncate every line to lineWidth in C.
+    lines = np.array(raw.splitlines(),dtype=f'S{lineWidth}')
+    chars = lines.view(np.uint8).reshape(-1,lineWidth)
+    return np.where(chars == 0,ord(' '),chars).astype(np.uint8)
+
+
+def fieldBytes(chars,column):
+    start, stop = columnSlices[column]
+    return np.ascontiguousarray(chars[:,start:stop]).view(f'S{stop-start}').ravel()
+
+
+def fieldDecimal(chars,column):
+    start, stop = columnSlices[column]
+    field = chars[:,start:stop]
+
+    # Coordinates are printed with a fixed number of decimals, so when every row has its '.' in the same place the value is plain
+    # digit arithmetic; anything else goes through numpy's (slower) string to float conversion.
+    points = np.flatnonzero(field[0] == ord('.'))
+    if len(points) != 1 or not (field[:,points[0]] == ord('.')).all():
+        return fieldBytes(chars,column).astype(np.float32)
+
+    point = points[0]
+    digits = field.astype(np.int32) - ord('0')
+    digits[(digits < 0) | (digits > 9)] = 0
+    positions = np.arange(field.shape[1])
+    weights = np.where(positions < point,10.0 ** (point-1-positions),10.0 ** (point-positions))
+    weights[point] = 0
+    values = digits @ weights
+    values[(field == ord('-')).any(axis=1)] *= -1
+    return values.astype(np.float32)
+
+
+def fieldYears(chars,column):
+    start, stop = columnSlices[column]
+    digits = chars[:,start:stop].astype(np.int16) - ord('0')
+    return (digits * np.array([1000,100,10,1],dtype=np.int16)).sum(axis=1,dtype=np.int16)
+
+
+def stationCategorical(chars):
+    start, stop = columnSlices['station']
+    ids = chars[:,start:stop]
+
+    # The published inventory is sorted by station, so codes are a running count of id changes.
+    changed = np.empty(len(ids),dtype=bool)
+    changed[:1] = True
+    changed[1:] = (ids[1:] != ids[:-1]).any(axis=1)
+    categories = fieldBytes(chars[changed],'station')
+
+    if (categories[1:] > categories[:-1]).all():
+        codes = (np.cumsum(changed) - 1).astype(np.int32)
+    else:
+        categories, codes = np.unique(fieldBytes(chars,'station'),return_inverse=True)
+        codes = codes.astype(np.int32)
+
+    return pd.Categorical.from_codes(codes,categories=pd.Index(categories.astype(str)))
+
+
+def measureCategorical(chars):
+    # Element names are four bytes, so hash them as uint32 and sort only the handful of distinct names.
+    codes, uniques = pd.factorize(np.ascontiguousarray(fieldBytes(chars,'measure')).view(np.uint32))
+    names = uniques.astype(np.uint32).view('S4')
+    order = np.argsort(names)
+    rank = np.empty(len(order),dtype=np.int16)
+    rank[order] = np.arange(len(order),dtype=np.int16)
+    return pd.Categorical.from_codes(rank[codes],categories=pd.Index(names[order].astype(str)))
+
+
+def parseInventory(raw):
+    chars = inventoryCharArray(raw)
+
+    return pd.DataFrame({'station':stationCategorical(chars),
+                         'latitude':fieldDecimal(chars,'latitude'),
+                         'longitude':fieldDecimal(chars,'longitude'),
+                         'measure':measureCategorical(chars),
+                         'begin':fieldYears(chars,'begin'),
+                         'end':fieldYears(chars,'end')})
+
+
+#*********************************************************************************************************************************************
+# Arrow snapshot cache
+#*********************************************************************************************************************************************
+
+def sourceFingerprint(source,storageOptions=None):
+    openFile = openSource(source,storageOptions)
+    info = openFile.fs.info(openFile.path)
+    version = info.get('ETag') or info.get('etag') or info.get('mtime') or info.get('LastModified')
+    return f"{version}|{info.get('size')}"
+
+
+def snapshotPrefix(source,cacheDir):
+    sourceKey = hashlib.sha1(source.encode()).hexdigest()[:12]
+    return os.path.join(cacheDir,f'inventory-{sourceKey}-')
+
+
+def snapshotPath(source,fingerprint,cacheDir):
+    versionKey = hashlib.sha1(f'{fingerprint}|v{snapshotVersion}'.encode()).hexdigest()[:12]
+    return f'{snapshotPrefix(source,cacheDir)}{versionKey}.arrow'
+
+
+def readSnapshot(path):
+    return feather.read_table(path,memory_map=True).to_pandas()
+
+
+def writeSnapshot(df,path):
+    os.makedirs(os.path.dirname(path),exist_ok=True)
+
+    # Uncompressed so the snapshot can be memory mapped; written to a temp file and renamed so readers never see half a file.
+    tempPath = f'{path}.{os.getpid()}.tmp'
+    feather.write_feather(df,tempPath,compression='uncompressed')
+    os.replace(tempPath,path)
+
+    for stale in glob.glob(f"{path.rsplit('-',1)[0]}-*.arrow"):
+        if stale != path:
+            os.remove(stale)
+
+
+def loadInventory(source=inventorySource,storageOptions=None,cacheDir=inventoryCacheDir):
+    if not cacheDir:
+        return parseInventory(readInventoryBytes(source,storageOptions))
+
+    try:
+        fingerprint = sourceFingerprint(source,storageOptions)
+    except (OSError,ValueError,BotoCoreError):
+        # Source unreachable (s3fs passes botocore's connection and credential errors through): fall back to the newest snapshot we
+        # have for it, if any.
+        snapshots = sorted(glob.glob(f'{snapshotPrefix(source,cacheDir)}*.arrow'),key=os.path.getmtime)
+        if snapshots:
+            return readSnapshot(snapshots[-1])
+        raise
+
+    path = snapshotPath(source,fingerprint,cacheDir)
+    if os.path.exists(path):
+        return readSnapshot(path)
+
+    inventory = parseInventory(readInventoryBytes(source,storageOptions))
+    try:
+        writeSnapshot(inventory,path)
+    except OSError:
+        pass
+    return inventory
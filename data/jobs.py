@@ -0,0 +1,241 @@
+#*********************************************************************************************************************************************
+# Redis backed download job queue and job state.
+#
+#   downloadJobQueue            list of queued job ids (LPUSH in, BRPOPLPUSH out)
+#   downloadJobProcessing       list of job ids a worker has taken
+#   downloadJob{id}             hash of job state: status, session, years, yearsDone, scans, scansDone, bytesPlanned, bytesScanned,
+#                               bytesWritten, error, cancelRequested
+#   downloadJobSpec{id}         encoded export spec (stations, measures, years, destination, credentials); deleted when the job finishes
+#   sessionDownloadJobs{uuid}   sorted set of a session's job ids by enqueue time
+#   downloadJobsRunning         sorted set of running job ids by last heartbeat (global concurrency)
+#   exportCheckpoint{hash}      encoded year boundary checkpoint of an export (next year, upload id, part ETags, unsent tail), keyed by
+#                               what is exported and where to, not by job, so a restarted or retried export resumes from it
+#   sessionJobsRunning{uuid}    sorted set of a session's running job ids by last heartbeat (per-session concurrency)
+#   downloadProgress{uuid}      pub/sub channel: the id of a session's job is published whenever its state hash changes
+# Running sets are leases: entries whose heartbeat is older than jobLeaseSeconds no longer count, so a crashed worker cannot hold a
+# slot forever and its job is put back on the queue by the next worker to start.
+#*********************************************************************************************************************************************
+import hashlib
+import os
+import time
+import uuid
+
+from data.sessionCodec import encode, decode
+
+
+queueKey = 'downloadJobQueue'
+processingKey = 'downloadJobProcessing'
+runningKey = 'downloadJobsRunning'
+
+globalJobLimit = int(os.environ.get('DownloadJobsGlobal',4))
+sessionJobLimit = int(os.environ.get('DownloadJobsPerSession',1))
+jobLeaseSeconds = int(os.environ.get('DownloadJobLease',120))
+jobTtl = int(os.environ.get('DownloadJobTtl',24*60*60))
+jobAttempts = int(os.environ.get('DownloadJobAttempts',3))
+
+finishedStatuses = {'done','failed','cancelled'}
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def jobKey(jobId):
+    return f'downloadJob{jobId}'
+
+def specKey(jobId):
+    return f'downloadJobSpec{jobId}'
+
+def sessionJobsKey(sessionID):
+    return f'sessionDownloadJobs{sessionID}'
+
+def sessionRunningKey(sessionID):
+    return f'sessionJobsRunning{sessionID}'
+
+
+def progressChannel(sessionID):
+    return f'downloadProgress{sessionID}'
+
+
+def checkpointKey(spec):
+    export = (sorted(spec['stations']),sorted(spec['measures']),spec['yearBegin'],spec['yearEnd'],spec.get('format','csv'),
+              spec['bucket'],spec['object'])
+    return f'exportCheckpoint{hashlib.sha1(repr(export).encode()).hexdigest()}'
+
+
+def decodeHash(values):
+    return {field.decode():value.decode() for field, value in values.items()}
+
+
+#*********************************************************************************************************************************************
+# Called from the Dash app
+#*********************************************************************************************************************************************
+
+def enqueueJob(client,sessionID,spec,scans=0):
+    jobId = uuid.uuid4().hex
+    now = time.time()
+
+    pipeline = client.pipeline(transaction=True)
+    pipeline.hset(jobKey(jobId),mapping={'status':'queued','session':sessionID,'created':now,
+                                         'yearBegin':spec['yearBegin'],'yearEnd':spec['yearEnd'],
+                                         'yearsDone':0,'scans':scans,'scansDone':0,'bytesPlanned':0,'bytesScanned':0,
+                                         'bytesWritten':0})
+    pipeline.expire(jobKey(jobId),jobTtl)
+    pipeline.set(specKey(jobId),encode(spec),ex=jobTtl)
+    pipeline.zadd(sessionJobsKey(sessionID),{jobId:now})
+    pipeline.expire(sessionJobsKey(sessionID),jobTtl)
+    pipeline.lpush(queueKey,jobId)
+    pipeline.publish(progressChannel(sessionID),jobId)
+    pipeline.execute()
+    return jobId
+
+
+def jobState(client,jobId):
+    if jobId is None:
+        return None
+    state = decodeHash(client.hgetall(jobKey(jobId)))
+    if state:
+        state['id'] = jobId
+    return state or None
+
+
+def latestJob(client,sessionID):
+    # The session's most recently started job, straight from its job list (no session cache payload to decode).
+    jobIds = client.zrange(sessionJobsKey(sessionID),-1,-1)
+    return jobIds[0].decode() if jobIds else None
+
+
+def listJobs(client,sessionID):
+    jobIds = [jobId.decode() for jobId in client.zrange(sessionJobsKey(sessionID),0,-1)]
+    pipeline = client.pipeline(transaction=False)
+    for jobId in jobIds:
+        pipeline.hgetall(jobKey(jobId))
+    return [dict(decodeHash(state),id=jobId) for jobId, state in zip(jobIds,pipeline.execute()) if state]
+
+
+def cancelJob(client,jobId):
+    client.hset(jobKey(jobId),'cancelRequested',1)
+    # Still waiting in the queue: take it out now.  A running job sees cancelRequested at its next year boundary.
+    if client.lrem(queueKey,0,jobId):
+        finishJob(client,jobId,'cancelled')
+
+
+#*********************************************************************************************************************************************
+# Called from download workers
+#*********************************************************************************************************************************************
+
+def claimJob(client,timeout=5):
+    jobId = client.brpoplpush(queueKey,processingKey,timeout=timeout)
+    if jobId is None:
+        return None
+    jobId = jobId.decode()
+
+    state = jobState(client,jobId)
+    if state is None or state['status'] in finishedStatuses or state.get('cancelRequested') == '1':
+        client.lrem(processingKey,0,jobId)
+        if state is not None and state['status'] not in finishedStatuses:
+            finishJob(client,jobId,'cancelled')
+        return None
+
+    sessionID = state['session']
+    now = time.time()
+    pipeline = client.pipeline(transaction=True)
+    pipeline.zadd(runningKey,{jobId:now})
+    pipeline.zadd(sessionRunningKey(sessionID),{jobId:now})
+    pipeline.zcount(runningKey,now-jobLeaseSeconds,'+inf')
+    pipeline.zcount(sessionRunningKey(sessionID),now-jobLeaseSeconds,'+inf')
+    globalRunning, sessionRunning = pipeline.execute()[2:]
+
+    if globalRunning > globalJobLimit or sessionRunning > sessionJobLimit:
+        # Over a limit: give the slot back and put the job at the back of the queue.
+        pipeline = client.pipeline(transaction=True)
+        pipeline.zrem(runningKey,jobId)
+        pipeline.zrem(sessionRunningKey(sessionID),jobId)
+        pipeline.lrem(processingKey,0,jobId)
+        pipeline.lpush(queueKey,jobId)
+        pipeline.execute()
+        return None
+
+    spec = decode(client.get(specKey(jobId)))
+    if spec is None:
+        finishJob(client,jobId,'failed','The download request expired.  Please start it again',sessionID)
+        return None
+
+    client.hset(jobKey(jobId),mapping={'status':'running','started':now})
+    return jobId, sessionID, spec
+
+
+def heartbeat(client,jobId,sessionID,progress=None):
+    now = time.time()
+    pipeline = client.pipeline(transaction=False)
+    pipeline.zadd(runningKey,{jobId:now})
+    pipeline.zadd(sessionRunningKey(sessionID),{jobId:now})
+    if progress:
+        pipeline.hset(jobKey(jobId),mapping=progress)
+        pipeline.publish(progressChannel(sessionID),jobId)
+    pipeline.hget(jobKey(jobId),'cancelRequested')
+    if pipeline.execute()[-1] == b'1':
+        raise JobCancelled(jobId)
+
+
+def retryJob(client,jobId,sessionID,error):
+    # Put a failed job back on the queue (its spec and export checkpoint are kept) until it has used up its attempts.
+    attempts = client.hincrby(jobKey(jobId),'attempts',1)
+    if attempts >= jobAttempts:
+        finishJob(client,jobId,'failed',error,sessionID)
+        return False
+
+    pipeline = client.pipeline(transaction=True)
+    pipeline.hset(jobKey(jobId),mapping={'status':'queued','error':error})
+    pipeline.lrem(processingKey,0,jobId)
+    pipeline.zrem(runningKey,jobId)
+    pipeline.zrem(sessionRunningKey(sessionID),jobId)
+    pipeline.rpush(queueKey,jobId)
+    pipeline.publish(progressChannel(sessionID),jobId)
+    pipeline.execute()
+    return True
+
+
+def loadCheckpoint(client,spec):
+    return decode(client.get(checkpointKey(spec)))
+
+
+def saveCheckpoint(client,spec,checkpoint):
+    client.set(checkpointKey(spec),encode(checkpoint),ex=jobTtl)
+
+
+def clearCheckpoint(client,spec):
+    client.delete(checkpointKey(spec))
+
+
+def finishJob(client,jobId,status,error=None,sessionID=None):
+    if sessionID is None:
+        sessionID = client.hget(jobKey(jobId),'session')
+        sessionID = sessionID.decode() if sessionID is not None else None
+    pipeline = client.pipeline(transaction=True)
+    state = {'status':status,'finished':time.time()}
+    if error is not None:
+        state['error'] = error
+    pipeline.hset(jobKey(jobId),mapping=state)
+    # The spec holds the user's credentials; they do not outlive the export.
+    pipeline.delete(specKey(jobId))
+    pipeline.lrem(processingKey,0,jobId)
+    pipeline.zrem(runningKey,jobId)
+    if sessionID is not None:
+        pipeline.zrem(sessionRunningKey(sessionID),jobId)
+        pipeline.publish(progressChannel(sessionID),jobId)
+    pipeline.execute()
+
+
+def requeueOrphans(client):
+    # Jobs a crashed worker had taken: in the processing list but no live lease.
+    now = time.time()
+    live = {jobId.decode() for jobId in client.zrangebyscore(runningKey,now-jobLeaseSeconds,'+inf')}
+    requeued = 0
+    for jobId in [jobId.decode() for jobId in client.lrange(processingKey,0,-1)]:
+        if jobId not in live and client.lrem(processingKey,0,jobId):
+            client.hset(jobKey(jobId),'status','queued')
+            client.rpush(queueKey,jobId)
+            requeued += 1
+    client.zremrangebyscore(runningKey,'-inf',now-jobLeaseSeconds)
+    return requeued
@@ -0,0 +1,91 @@
+#*********************************************************************************************************************************************
+# Station map figure as a plain dict.
+#
+# go.Figure runs plotly's validators over every array element on each callback; the map only ever needs one scattermapbox trace and a
+# fixed layout, so they are written as dicts.  Coordinates go out rounded to 4 decimals (about 10 m), or with MapTypedArrays=1 as
+# base64 typed arrays ({'dtype','bdata'}, needs plotly.js 2.28 or later in the browser).  Built traces are kept in a small LRU keyed by
+# the filter result hash and level of detail, so moving the map without changing what is shown only rebuilds the layout.
+#*********************************************************************************************************************************************
+import base64
+import collections
+import os
+import threading
+
+import numpy as np
+
+
+typedArrays = os.environ.get('MapTypedArrays','0') == '1'
+traceCacheSize = int(os.environ.get('MapTraceCacheSize',16))
+
+
+def coordinates(values):
+    if typedArrays:
+        return {'dtype':'f4','bdata':base64.b64encode(np.ascontiguousarray(values,dtype='<f4').tobytes()).decode()}
+    return np.round(np.asarray(values,dtype=np.float64),4).tolist()
+
+
+def stationTrace(frame):
+    return {'type':'scattermapbox',
+            'lat':coordinates(frame['latitude'].values),
+            'lon':coordinates(frame['longitude'].values),
+            'mode':'markers',
+            'name':'',
+            'marker':{'size':2,'color':'red'},
+            'text':frame['station'].astype(str).tolist(),
+            'hovertemplate':'station: %{text}',
+            'selected':{'marker':{'color':'#39FF14','size':3}}}
+
+
+def clusterTrace(frame):
+    # customdata lets a lasso or box selection of clusters resolve back to the stations in them.
+    counts = frame['count'].values
+    return {'type':'scattermapbox',
+            'lat':coordinates(frame['latitude'].values),
+            'lon':coordinates(frame['longitude'].values),
+            'mode':'markers',
+            'name':'',
+            'marker':{'size':np.round(np.clip(2 + 2*np.log2(counts),2,16),1).tolist(),'color':'red'},
+            'text':counts.tolist(),
+            'customdata':[[cellSize,cell] for cellSize, cell in zip(frame['cellSize'].tolist(),frame['cell'].tolist())],
+            'hovertemplate':'%{text} stations',
+            'selected':{'marker':{'color':'#39FF14'}}}
+
+
+def mapLayout(centerLat,centerLon,zoom,accessToken):
+    return {'autosize':False,
+            'hovermode':'closest',
+            'mapbox':{'accesstoken':accessToken,'bearing':0,'center':{'lat':centerLat,'lon':centerLon},'pitch':0,'zoom':zoom,
+                      'style':'dark'},
+            'margin':{'r':0,'t':0,'l':0,'b':0}}
+
+
+def mapFigure(trace,centerLat,centerLon,zoom,accessToken):
+    return {'data':[trace],'layout':mapLayout(centerLat,centerLon,zoom,accessToken)}
+
+
+class TraceCache:
+
+    def __init__(self,maxEntries=traceCacheSize):
+        self.maxEntries = maxEntries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self,key,build):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+
+        trace = build()
+        if trace is None:
+            return None
+
+        with self.lock:
+            self.misses += 1
+            self.entries[key] = trace
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+        return trace
@@ -0,0 +1,265 @@
+#*********************************************************************************************************************************************
+# Multi-resolution measure presence grid over the inventory, built once at load time.
+#
+# Base cells are cellSize degree lat/lon cells numbered in Morton (Z) order, so the 4**level base cells under a level cell are one
+# contiguous run of codes and each level is the one below it with codes shifted right by two bits.  Every occupied cell of every level
+# holds a packed bitmask of the measures reported in it and, for each (cell, measure) pair that occurs, the (begin, end) of four of its
+# rows: earliest begin, latest begin, earliest end and latest end.  Those give the pair's year bounds and, being real rows, witnesses
+# for the year filter.  Pairs are kept sparse, sorted by cell position * measureCount + measure.
+#
+# measureCodes covers a viewport with the coarsest cells that lie inside it.  Without a year filter the answer is the OR of their
+# bitmasks plus the raw rows (stations inside the viewport only) of the partly covered base cells along its edge.  With one, a matching
+# witness settles a measure at once and the year bounds rule it out of most other cells; what is left is refined a level at a time and,
+# at base cells, decided by their rows.  The work follows the viewport's outline, not the number of stations inside it.
+#*********************************************************************************************************************************************
+import collections
+import math
+
+import numpy as np
+
+from data.spatialIndex import splitLongitudes
+
+
+PyramidLevel = collections.namedtuple('PyramidLevel',['cells','bits','pairKey','firstBegin','lastBegin','firstEnd','lastEnd'])
+
+
+def spreadBits(values):
+    values = np.asarray(values,dtype=np.int64) & 0xFFFF
+    values = (values | (values << 8)) & 0x00FF00FF
+    values = (values | (values << 4)) & 0x0F0F0F0F
+    values = (values | (values << 2)) & 0x33333333
+    return (values | (values << 1)) & 0x55555555
+
+
+def compactBits(values):
+    values = np.asarray(values,dtype=np.int64) & 0x55555555
+    values = (values | (values >> 1)) & 0x33333333
+    values = (values | (values >> 2)) & 0x0F0F0F0F
+    values = (values | (values >> 4)) & 0x00FF00FF
+    return (values | (values >> 8)) & 0x0000FFFF
+
+
+def mortonCode(columns,rows):
+    return spreadBits(columns) | (spreadBits(rows) << 1)
+
+
+def mortonCell(codes):
+    return compactBits(codes), compactBits(np.asarray(codes,dtype=np.int64) >> 1)
+
+
+def yearKey(major,minor):
+    # One row's years packed so that min / max order by major, then by minor the opposite way: the earliest begin key is the earliest
+    # begin with the latest end it has.
+    major = np.asarray(major,dtype=np.int64) + 32768
+    minor = 32767 - np.asarray(minor,dtype=np.int64)
+    return ((major << 16) | minor).astype(np.uint32)
+
+
+def unpackKey(key):
+    key = np.asarray(key,dtype=np.int64)
+    return (key >> 16) - 32768, 32767 - (key & 0xFFFF)
+
+
+def yearMatch(begin,end,years):
+    # The dateRangeInsideOutside modes, as in StationTable.select and YearIntervalIndex.query.
+    low, high, rangeMode = years
+    if rangeMode == 'in':
+        return (begin <= low) & (end >= high)
+    elif rangeMode == 'out':
+        return (begin >= low) & (end <= high)
+    return (begin == low) & (end == high)
+
+
+def spanIndices(first,counts):
+    # Concatenation of arange(first[i], first[i] + counts[i]).
+    ends = np.cumsum(counts)
+    return np.arange(ends[-1] if len(ends) else 0) + np.repeat(first - ends + counts,counts)
+
+
+def witnessRows(level,pairs):
+    # (begin, end) of the four kept rows of each pair.
+    firstBegin, endAtFirstBegin = unpackKey(level.firstBegin[pairs])
+    lastBegin, endAtLastBegin = unpackKey(level.lastBegin[pairs])
+    firstEnd, beginAtFirstEnd = unpackKey(level.firstEnd[pairs])
+    lastEnd, beginAtLastEnd = unpackKey(level.lastEnd[pairs])
+    return [(firstBegin,endAtFirstBegin),(lastBegin,endAtLastBegin),(beginAtFirstEnd,firstEnd),(beginAtLastEnd,lastEnd)]
+
+
+def yearBounds(level,pairs,years):
+    # admit: False where no row of the pair can match the years.  found: one of its kept rows matches them.
+    low, high, rangeMode = years
+    rows = witnessRows(level,pairs)
+    (minBegin, _), (maxBegin, _), (_, minEnd), (_, maxEnd) = rows
+    if rangeMode == 'in':
+        admit = (minBegin <= low) & (maxEnd >= high)
+    elif rangeMode == 'out':
+        admit = (maxBegin >= low) & (minEnd <= high)
+    else:
+        admit = (minBegin <= low) & (maxBegin >= low) & (minEnd <= high) & (maxEnd >= high)
+    found = np.logical_or.reduce([yearMatch(begin,end,years) for begin, end in rows])
+    return admit, found
+
+
+class MeasurePyramid:
+
+    def __init__(self,latitude,longitude,measureCodes,begin,end,measureCount,cellSize=1.0):
+        self.cellSize = cellSize
+        self.measureCount = measureCount
+        latCells = int(math.ceil(180 / cellSize))
+        lonCells = int(math.ceil(360 / cellSize))
+        self.top = max(1,int(math.ceil(math.log2(max(latCells,lonCells)))))
+
+        rows = np.clip(np.floor((np.asarray(latitude,dtype=np.float64) + 90) / cellSize),0,latCells-1).astype(np.int64)
+        columns = np.clip(np.floor((np.asarray(longitude,dtype=np.float64) + 180) / cellSize),0,lonCells-1).astype(np.int64)
+        codes = mortonCode(columns,rows)
+        measureCodes = np.asarray(measureCodes,dtype=np.int64)
+
+        # Raw rows in (base cell, measure) order for the edge cells and for confirming a measure in a base cell.
+        order = np.lexsort((measureCodes,codes))
+        codes = codes[order]
+        measureCodes = measureCodes[order]
+        self.rowLatitude = np.asarray(latitude,dtype=np.float32)[order]
+        self.rowLongitude = np.asarray(longitude,dtype=np.float32)[order]
+        self.rowMeasure = measureCodes.astype(np.int16)
+        self.rowBegin = np.asarray(begin)[order].astype(np.int16)
+        self.rowEnd = np.asarray(end)[order].astype(np.int16)
+
+        cells, position = np.unique(codes,return_inverse=True)
+        self.rowKey = position * measureCount + measureCodes
+        self.cellRowStart = np.searchsorted(self.rowKey,np.arange(len(cells)+1) * measureCount)
+
+        # Each level's pairs reduce the rows (base level) or the child pairs (above it) with the same parent pair.
+        pairKey = self.rowKey
+        keys = [yearKey(self.rowBegin,self.rowEnd)]*2 + [yearKey(self.rowEnd,self.rowBegin)]*2
+        self.levels = []
+        for depth in range(self.top+1):
+            if depth:
+                parents, position = np.unique(cells >> 2,return_inverse=True)
+                pairKey = position[pairKey // measureCount] * measureCount + pairKey % measureCount
+                order = np.argsort(pairKey,kind='stable')
+                pairKey = pairKey[order]
+                keys = [kept[order] for kept in keys]
+                cells = parents
+            starts = np.flatnonzero(np.r_[True,pairKey[1:] != pairKey[:-1]]) if len(pairKey) else np.empty(0,dtype=np.int64)
+            pairKey = pairKey[starts]
+            keys = [reduce.reduceat(kept,starts) if len(starts) else kept
+                    for reduce, kept in zip([np.minimum,np.maximum,np.minimum,np.maximum],keys)]
+            self.levels.append(self.level(cells,pairKey,*keys))
+
+    def level(self,cells,pairKey,firstBegin,lastBegin,firstEnd,lastEnd):
+        present = np.zeros((len(cells),self.measureCount),dtype=bool)
+        present[pairKey // self.measureCount,pairKey % self.measureCount] = True
+        return PyramidLevel(cells,np.packbits(present,axis=1,bitorder='little'),pairKey,firstBegin,lastBegin,firstEnd,lastEnd)
+
+    def cellPairs(self,level,positions):
+        # Indices of every pair of the given cells.
+        first = np.searchsorted(level.pairKey,positions * self.measureCount)
+        return spanIndices(first,np.searchsorted(level.pairKey,(positions+1) * self.measureCount) - first)
+
+    def cover(self,west,south,east,north):
+        # The occupied cells inside the box as (level, positions), coarsest first, and the occupied base cells its edge runs through.
+        inside = []
+        if len(self.levels[0].cells) == 0:
+            return inside, np.empty(0,dtype=np.int64)
+        codes = np.zeros(1,dtype=np.int64)
+        for depth in range(self.top,-1,-1):
+            level = self.levels[depth]
+            positions = np.minimum(np.searchsorted(level.cells,codes),len(level.cells)-1)
+            occupied = level.cells[positions] == codes
+            codes, positions = codes[occupied], positions[occupied]
+
+            size = (1 << depth) * self.cellSize
+            columns, rows = mortonCell(codes)
+            cellWest = columns * size - 180
+            cellSouth = rows * size - 90
+            cellEast = np.minimum(cellWest + size,180)
+            cellNorth = np.minimum(cellSouth + size,90)
+
+            overlaps = (cellWest <= east) & (cellEast >= west) & (cellSouth <= north) & (cellNorth >= south)
+            within = overlaps & (cellWest >= west) & (cellEast <= east) & (cellSouth >= south) & (cellNorth <= north)
+            if within.any():
+                inside.append((depth,positions[within]))
+
+            partial = overlaps & ~within
+            if depth == 0:
+                return inside, positions[partial]
+            codes = ((codes[partial] << 2)[:,None] + np.arange(4)).ravel()
+
+    def edgeMeasures(self,edge,west,south,east,north,years):
+        present = np.zeros(self.measureCount,dtype=bool)
+        if len(edge) == 0:
+            return present
+
+        rows = spanIndices(self.cellRowStart[edge],self.cellRowStart[edge+1] - self.cellRowStart[edge])
+        latitude = self.rowLatitude[rows]
+        longitude = self.rowLongitude[rows]
+        keep = (latitude >= south) & (latitude <= north) & (longitude >= west) & (longitude <= east)
+        if years is not None:
+            keep &= yearMatch(self.rowBegin[rows],self.rowEnd[rows],years)
+        present[self.rowMeasure[rows[keep]]] = True
+        return present
+
+    def insideMeasures(self,inside,years,known):
+        present = np.zeros(self.measureCount,dtype=bool)
+        if not inside:
+            return present
+
+        bits = np.bitwise_or.reduce([np.bitwise_or.reduce(self.levels[depth].bits[positions],axis=0) for depth, positions in inside])
+        present = np.unpackbits(bits,bitorder='little')[:self.measureCount].astype(bool)
+        if years is None:
+            return present
+
+        # (cell, measure) pairs the year bounds admit are refined a level at a time, all measures together, dropping every measure a
+        # witness has found; base cells left over are decided by their rows.
+        undecided = present & ~known
+        present = known.copy()
+        frontier = {}
+        for depth, positions in inside:
+            level = self.levels[depth]
+            pairs = self.cellPairs(level,positions)
+            pairs = pairs[undecided[level.pairKey[pairs] % self.measureCount]]
+            frontier[depth] = pairs[yearBounds(level,pairs,years)[0]]
+
+        pairs = np.empty(0,dtype=np.int64)
+        for depth in range(self.top,-1,-1):
+            level = self.levels[depth]
+            pairs = np.concatenate([pairs,frontier.get(depth,pairs[:0])])
+
+            measures = level.pairKey[pairs] % self.measureCount
+            present[measures[yearBounds(level,pairs,years)[1]]] = True
+            pairs = pairs[~present[level.pairKey[pairs] % self.measureCount]]
+            if len(pairs) == 0:
+                continue
+            if depth == 0:
+                present[self.confirmedMeasures(level.pairKey[pairs],years)] = True
+                break
+
+            pairs = self.childPairs(depth,pairs)
+            pairs = pairs[yearBounds(self.levels[depth-1],pairs,years)[0]]
+        return present
+
+    def childPairs(self,depth,pairs):
+        # The same measure's pairs in the occupied child cells, one level down.
+        level, below = self.levels[depth], self.levels[depth-1]
+        positions, measures = np.divmod(level.pairKey[pairs],self.measureCount)
+        codes = level.cells[positions] << 2
+        first = np.searchsorted(below.cells,codes)
+        counts = np.searchsorted(below.cells,codes+4) - first
+        keys = spanIndices(first,counts) * self.measureCount + np.repeat(measures,counts)
+        children = np.minimum(np.searchsorted(below.pairKey,keys),len(below.pairKey)-1)
+        return children[below.pairKey[children] == keys]
+
+    def confirmedMeasures(self,keys,years):
+        first = np.searchsorted(self.rowKey,keys)
+        rows = spanIndices(first,np.searchsorted(self.rowKey,keys+1) - first)
+        return self.rowMeasure[rows[yearMatch(self.rowBegin[rows],self.rowEnd[rows],years)]]
+
+    def measureCodes(self,viewport=None,years=None):
+        # Codes of the measures with at least one inventory row inside the viewport (west, south, east, north) that matches the years.
+        west, south, east, north = (-180.0,-90.0,180.0,90.0) if viewport is None else viewport
+        present = np.zeros(self.measureCount,dtype=bool)
+        for lonMin, lonMax in splitLongitudes(west,east):
+            inside, edge = self.cover(lonMin,south,lonMax,north)
+            present |= self.edgeMeasures(edge,lonMin,south,lonMax,north,years)
+            present |= self.insideMeasures(inside,years,present)
+        return np.flatnonzero(present)
@@ -0,0 +1,174 @@
+#*********************************************************************************************************************************************
+# Local Parquet mirror of GHCN-Daily and the export backend that reads it.
+#
+#   python -m data.parquetMirror ingest <source> <firstYear> [lastYear]     source is a directory of {year}.csv or s3://noaa-ghcn-pds/csv
+#   python -m data.parquetMirror query <year> <element> <station,...>      print what an export would read, as S3 Select CSV
+#
+# The mirror (ParquetMirrorPath, a local path or any pyarrow filesystem URI) holds year={year}/element={element}/data.parquet, each file
+# sorted by station and date and cut into row groups of MirrorRowGroupRows.  A query only reads the element files it needs and, within
+# them, only the row groups whose ID min / max statistics bracket one of the wanted stations.  With ExportBackend=parquet the download
+# path calls mirrorSelect instead of S3 Select and gets the same CSV records back.
+#*********************************************************************************************************************************************
+import bisect
+import os
+import shutil
+import sys
+import tempfile
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+
+from data.download import ScanStopped, csvColumns, csvTypes, spoolBytes
+from data.inventory import openSource
+
+
+parquetMirrorPath = os.environ.get('ParquetMirrorPath','tmp/ghcn-parquet')
+rowGroupRows = int(os.environ.get('MirrorRowGroupRows',64*2**10))
+ingestBlockBytes = 64*2**20
+
+mirrorSchema = pa.schema([('ID',pa.string()),
+                          ('DATE',pa.date32()),
+                          ('DATA_VALUE',pa.int32()),
+                          ('M_FLAG',pa.string()),
+                          ('Q_FLAG',pa.string()),
+                          ('S_FLAG',pa.string()),
+                          ('OBS_TIME',pa.string())])
+
+
+def mirrorFilesystem(mirror=parquetMirrorPath):
+    if '://' not in mirror:
+        mirror = os.path.abspath(mirror)
+    return pafs.FileSystem.from_uri(mirror)
+
+
+def partitionPath(root,year,element):
+    return f'{root}/year={year}/element={element}/data.parquet'
+
+
+#*********************************************************************************************************************************************
+# Ingest
+#*********************************************************************************************************************************************
+
+def yearSource(source,year):
+    return f"{source.rstrip('/')}/{year}.csv"
+
+
+def mirrorTable(batch):
+    date = pc.cast(pc.strptime(batch.column('YEAR_MONTH_DAY'),format='%Y%m%d',unit='s'),pa.date32())
+    return pa.Table.from_arrays([batch.column('ID'),date,batch.column('DATA_VALUE'),batch.column('M_FLAG'),
+                                 batch.column('Q_FLAG'),batch.column('S_FLAG'),batch.column('OBS_TIME')],schema=mirrorSchema)
+
+
+def ingestYear(source,year,mirror=parquetMirrorPath):
+    # Split the year by element into staging files as it streams in, then sort one element at a time, so memory peaks at the largest
+    # element of the year rather than the whole year.
+    filesystem, root = mirrorFilesystem(mirror)
+    staging = tempfile.mkdtemp(prefix=f'ghcn-{year}-')
+    writers = {}
+    rows = 0
+
+    try:
+        with openSource(yearSource(source,year)) as f:
+            reader = pacsv.open_csv(f,read_options=pacsv.ReadOptions(column_names=csvColumns,block_size=ingestBlockBytes),
+                                    convert_options=pacsv.ConvertOptions(column_types=csvTypes,strings_can_be_null=True))
+            for batch in reader:
+                elements = batch.column('ELEMENT')
+                table = mirrorTable(batch)
+                for element in pc.unique(elements).to_pylist():
+                    if element not in writers:
+                        writers[element] = pq.ParquetWriter(os.path.join(staging,f'{element}.parquet'),mirrorSchema)
+                    writers[element].write_table(table.filter(pc.equal(elements,element)))
+                rows += batch.num_rows
+        for writer in writers.values():
+            writer.close()
+
+        for element in sorted(writers):
+            table = pq.read_table(os.path.join(staging,f'{element}.parquet')).sort_by([('ID','ascending'),('DATE','ascending')])
+            path = partitionPath(root,year,element)
+            filesystem.create_dir(path.rsplit('/',1)[0],recursive=True)
+            # Write beside the final name and move it over, so a query never sees half a file.
+            with filesystem.open_output_stream(f'{path}.tmp') as sink:
+                pq.write_table(table,sink,row_group_size=rowGroupRows,compression='zstd',write_statistics=True)
+            filesystem.move(f'{path}.tmp',path)
+            os.remove(os.path.join(staging,f'{element}.parquet'))
+    finally:
+        shutil.rmtree(staging,ignore_errors=True)
+
+    return rows, sorted(writers)
+
+
+#*********************************************************************************************************************************************
+# Query
+#*********************************************************************************************************************************************
+
+def matchingRowGroups(metadata,stations):
+    # Row groups whose [min, max] ID range contains one of the (sorted) stations; groups without statistics are always read.
+    idColumn = metadata.schema.names.index('ID')
+    groups = []
+    for group in range(metadata.num_row_groups):
+        statistics = metadata.row_group(group).column(idColumn).statistics
+        if statistics is None or not statistics.has_min_max:
+            groups.append(group)
+            continue
+        position = bisect.bisect_left(stations,statistics.min)
+        if position < len(stations) and stations[position] <= statistics.max:
+            groups.append(group)
+    return groups
+
+
+def writeRecords(spool,table,element):
+    # The same columns and text as S3 Select's CSV output: no header, no quoting, empty fields for nulls.
+    frame = table.to_pandas()
+    frame.insert(2,'ELEMENT',element)
+    frame['DATE'] = pc.strftime(table.column('DATE'),format='%Y%m%d').to_pandas()
+    spool.write(frame.to_csv(header=False,index=False).encode())
+
+
+def mirrorSelect(task,mirror=parquetMirrorPath,stop=None):
+    filesystem, root = mirrorFilesystem(mirror)
+    stations = sorted(task.stations)
+    stationSet = pa.array(stations,type=pa.string())
+    spool = tempfile.SpooledTemporaryFile(max_size=spoolBytes)
+
+    try:
+        for element in task.measures:
+            path = partitionPath(root,task.year,element)
+            if filesystem.get_file_info(path).type == pafs.FileType.NotFound:
+                continue
+            with filesystem.open_input_file(path) as f:
+                parquetFile = pq.ParquetFile(f)
+                for group in matchingRowGroups(parquetFile.metadata,stations):
+                    if stop is not None and stop.is_set():
+                        raise ScanStopped(task.year)
+                    table = parquetFile.read_row_group(group)
+                    table = table.filter(pc.is_in(table.column('ID'),value_set=stationSet))
+                    if table.num_rows:
+                        writeRecords(spool,table,element)
+    except Exception:
+        spool.close()
+        raise
+
+    size = spool.tell()
+    spool.seek(0)
+    return task.year, spool, size
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+
+    if command == 'ingest':
+        source, firstYear = sys.argv[2], int(sys.argv[3])
+        lastYear = int(sys.argv[4]) if len(sys.argv) > 4 else firstYear
+        for year in range(firstYear,lastYear+1):
+            rows, elements = ingestYear(source,year)
+            print(f'{year}: {rows} rows, {len(elements)} elements')
+    elif command == 'query':
+        from data.download import ScanTask
+        year, element, stations = int(sys.argv[2]), sys.argv[3], sys.argv[4].split(',')
+        year, spool, size = mirrorSelect(ScanTask(year,stations,[element]))
+        sys.stdout.write(spool.read().decode())
+    else:
+        print('usage: python -m data.parquetMirror ingest <source> <firstYear> [lastYear] | query <year> <element> <station,...>')
@@ -0,0 +1,64 @@
+#*********************************************************************************************************************************************
+# Content addressed cache of filter results shared by every session.
+#
+# A result is stored once under a hash of the normalized FilterSpec (plus the inventory version, since results are row / station
+# indices into it) as a compact int32 index array.  Sessions only keep that hash, so visitors on the same filters share one copy.
+# Entries never change under a given hash, so the in-process L1 can serve them without a version check.
+#*********************************************************************************************************************************************
+import hashlib
+import os
+
+import numpy as np
+
+from data.sessionCodec import encode, decode
+
+
+resultTtl = int(os.environ.get('ResultTtl',24*60*60))
+
+immutableVersion = b'0'
+
+
+def resultKey(spec,level,inventoryVersion):
+    return hashlib.sha1(repr((inventoryVersion,level,tuple(spec))).encode()).hexdigest()
+
+
+class ResultCache:
+
+    def __init__(self,client,ttl=resultTtl,l1=None):
+        self.client = client
+        self.ttl = ttl
+        self.l1 = l1
+
+    @staticmethod
+    def key(resultHash):
+        return f"resultCache{resultHash}"
+
+    def exists(self,resultHash):
+        # Touching the key also slides its expiry, so popular results stay cached.
+        return bool(self.client.expire(self.key(resultHash),self.ttl))
+
+    def put(self,resultHash,indices):
+        payload = encode(np.asarray(indices,dtype=np.int32))
+        self.client.set(self.key(resultHash),payload,ex=self.ttl)
+        if self.l1 is not None:
+            self.l1.put(self.key(resultHash),immutableVersion,decode(payload),len(payload))
+
+    def get(self,resultHash):
+        if resultHash is None:
+            return None
+
+        if self.l1 is not None:
+            hit, indices = self.l1.get(self.key(resultHash),immutableVersion)
+            if hit:
+                self.client.expire(self.key(resultHash),self.ttl)
+                return indices
+
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.get(self.key(resultHash))
+        pipeline.expire(self.key(resultHash),self.ttl)
+        payload = pipeline.execute()[0]
+
+        indices = decode(payload)
+        if self.l1 is not None and payload is not None:
+            self.l1.put(self.key(resultHash),immutableVersion,indices,len(payload))
+        return indices
@@ -0,0 +1,46 @@
+#*********************************************************************************************************************************************
+# Session cache report / reaper.
+#
+#   python -m data.sessionAdmin report [top]   total session bytes, session count, largest and oldest sessions, L1 hit rate, stale
+#                                               callback requests dropped per channel
+#   python -m data.sessionAdmin reap           drop accounting for sessions idle longer than SessionTtl (run from cron)
+#*********************************************************************************************************************************************
+import sys
+import time
+
+from data.sessionStore import sessionCache
+from data.generations import sessionGenerations
+
+
+def printReport(top):
+    report = sessionCache.report(top)
+    now = time.time()
+
+    print(f"{report['sessions']} sessions, {report['totalBytes']/2**20:.1f} MB total")
+    hits, misses = report['l1'].get('hits',0), report['l1'].get('misses',0)
+    if hits + misses:
+        print(f'L1 cache: {hits} hits, {misses} misses ({hits/(hits+misses):.0%} hit rate)')
+    generationStats = sessionGenerations.stats()
+    for channel in sorted({field.split(':')[0] for field in generationStats} - {'coalesced'}):
+        started = generationStats.get(f'{channel}:started',0)
+        skipped = {field.split(':')[2]:count for field, count in generationStats.items() if field.startswith(f'{channel}:skipped:')}
+        steps = ', '.join(f'{step} {count}' for step, count in sorted(skipped.items()))
+        print(f'{channel}: {started} requests, {sum(skipped.values())} dropped as stale' + (f' ({steps})' if steps else ''))
+    if generationStats.get('coalesced'):
+        print(f"{generationStats['coalesced']} computations shared with a concurrent identical request")
+    print('Largest:')
+    for sessionID, size in report['largest']:
+        print(f'  {sessionID}  {size/2**10:10.1f} KB')
+    print('Oldest:')
+    for sessionID, seen in report['oldest']:
+        print(f'  {sessionID}  idle {(now-seen)/60:8.1f} min')
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'report'
+
+    if command == 'reap':
+        sessions, reclaimed = sessionCache.reap()
+        print(f'Reaped {sessions} sessions, {reclaimed/2**20:.1f} MB')
+    else:
+        printReport(int(sys.argv[2]) if len(sys.argv) > 2 else 10)
@@ -0,0 +1,71 @@
+#*********************************************************************************************************************************************
+# Session cache codec.
+#
+# Every cached value is a one byte tag followed by its payload:
+#   b'A'  a DataFrame as an Arrow IPC stream with LZ4 / ZSTD buffer compression
+#   b'N'  a 1-D numpy array (e.g. int32 row indices) as its dtype string and raw bytes
+#   b'M'  anything else (option lists, slider dicts, years) as msgpack
+# Decoding wraps the Redis bytes in an Arrow buffer / numpy view without copying them.
+#*********************************************************************************************************************************************
+import os
+
+import msgpack
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+
+tableTag = b'A'
+arrayTag = b'N'
+valueTag = b'M'
+
+sessionCompression = os.environ.get('SessionCompression','lz4')
+
+
+def packDefault(value):
+    if isinstance(value,np.generic):
+        return value.item()
+    if isinstance(value,np.ndarray):
+        return value.tolist()
+    raise TypeError(f'Cannot cache value of type {type(value).__name__}')
+
+
+def encodeTable(df,compression=sessionCompression):
+    table = pa.Table.from_pandas(df,preserve_index=False)
+    options = pa.ipc.IpcWriteOptions(compression=None if compression == 'none' else compression)
+
+    sink = pa.BufferOutputStream()
+    sink.write(tableTag)
+    with pa.ipc.new_stream(sink,table.schema,options=options) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def encodeArray(array):
+    array = np.ascontiguousarray(array)
+    dtype = array.dtype.str.encode()
+    return arrayTag + bytes([len(dtype)]) + dtype + array.tobytes()
+
+
+def encode(value,compression=sessionCompression):
+    if isinstance(value,pd.DataFrame):
+        return encodeTable(value,compression)
+    if isinstance(value,np.ndarray) and value.ndim == 1:
+        return encodeArray(value)
+    return valueTag + msgpack.packb(value,default=packDefault,use_bin_type=True)
+
+
+def decode(payload):
+    if payload is None:
+        return None
+
+    view = memoryview(payload)
+    tag = bytes(view[:1])
+    if tag == tableTag:
+        return pa.ipc.open_stream(pa.py_buffer(view[1:])).read_all().to_pandas()
+    elif tag == arrayTag:
+        dtypeLength = view[1]
+        return np.frombuffer(view[2+dtypeLength:],dtype=bytes(view[2:2+dtypeLength]).decode())
+    elif tag == valueTag:
+        return msgpack.unpackb(view[1:],raw=False,strict_map_key=False)
+    raise ValueError(f'Unknown session cache tag {tag!r}')
@@ -0,0 +1,275 @@
+#*********************************************************************************************************************************************
+# Shared session cache client.
+#
+# One Redis client with a bounded, blocking connection pool is shared by every module.  Reads of several keys go out as a single MGET,
+# writes of several keys as a single pipeline, and decoded values are memoized on flask.g so repeated reads inside one callback request
+# do not go back to Redis.  SessionStore takes any redis-py compatible client, so it runs against fakeredis as well.
+#
+# Session keys carry a sliding TTL that every read or write refreshes.  Each session's key sizes are kept in sessionKeys{uuid}, and the
+# sessionBytes / sessionSeen sorted sets plus the sessionBytesTotal counter track size and last access across sessions, so a session
+# over its byte budget evicts its own largest keys and `python -m data.sessionAdmin` can report on and reap expired sessions.
+#
+# Decoded values are also kept in an in-process L1 (LRU, bounded by bytes) in front of Redis.  Every write stamps the key with the next
+# number of one global sequence (sessionVersionSequence, which never expires), so a read first fetches the versions and only transfers
+# and decodes the values whose L1 copy is stale.  A version is never reused, even after its key was evicted or expired.  L1 hit / miss
+# counts are flushed into the sessionL1Stats hash with the next read.
+#*********************************************************************************************************************************************
+import collections
+import logging
+import os
+import threading
+import time
+
+import flask
+import redis
+
+from data.sessionCodec import encode, decode
+
+
+sessionTtl = int(os.environ.get('SessionTtl',2*60*60))
+sessionByteBudget = int(os.environ.get('SessionByteBudget',32*2**20))
+
+totalBytesKey = 'sessionBytesTotal'
+sessionBytesKey = 'sessionBytes'
+sessionSeenKey = 'sessionSeen'
+l1StatsKey = 'sessionL1Stats'
+versionSequenceKey = 'sessionVersionSequence'
+
+l1CacheBytes = int(os.environ.get('L1CacheBytes',64*2**20))
+
+
+def connectRedis():
+    pool = redis.BlockingConnectionPool(host=os.environ['RedisEndpoint'],
+                                        port=os.environ['RedisPort'],
+                                        password=os.environ['RedisPassword'],
+                                        max_connections=int(os.environ.get('RedisMaxConnections',16)),
+                                        timeout=int(os.environ.get('RedisPoolTimeout',5)))
+    return redis.StrictRedis(connection_pool=pool)
+
+
+class L1Cache:
+
+    def __init__(self,maxBytes=l1CacheBytes):
+        self.maxBytes = maxBytes
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.pendingHits = 0
+        self.pendingMisses = 0
+
+    def get(self,key,version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and version is not None and entry[0] == version:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                self.pendingHits += 1
+                return True, entry[1]
+            self.misses += 1
+            self.pendingMisses += 1
+            return False, None
+
+    def put(self,key,version,value,size):
+        with self.lock:
+            self.discard(key)
+            if version is None or size > self.maxBytes:
+                return
+            self.entries[key] = (version,value,size)
+            self.bytes += size
+            while self.bytes > self.maxBytes:
+                self.bytes -= self.entries.popitem(last=False)[1][2]
+
+    def discard(self,key):
+        entry = self.entries.pop(key,None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def takePending(self):
+        with self.lock:
+            pending = (self.pendingHits,self.pendingMisses)
+            self.pendingHits = self.pendingMisses = 0
+        return pending
+
+    def flushStats(self,pipeline):
+        hits, misses = self.takePending()
+        if hits:
+            pipeline.hincrby(l1StatsKey,'hits',hits)
+        if misses:
+            pipeline.hincrby(l1StatsKey,'misses',misses)
+
+    def stats(self):
+        with self.lock:
+            return {'hits':self.hits,'misses':self.misses,'entries':len(self.entries),'bytes':self.bytes}
+
+
+class SessionStore:
+
+    def __init__(self,client,ttl=sessionTtl,byteBudget=sessionByteBudget,l1=None):
+        self.client = client
+        self.ttl = ttl
+        self.byteBudget = byteBudget
+        self.l1 = L1Cache() if l1 is None else l1
+
+    @staticmethod
+    def key(keyname,sessionID):
+        return f"{keyname}Cache{sessionID}"
+
+    @staticmethod
+    def versionKey(key):
+        return f"{key}Version"
+
+    @staticmethod
+    def sizesKey(sessionID):
+        return f"sessionKeys{sessionID}"
+
+    @staticmethod
+    def requestMemo():
+        if flask.has_app_context():
+            return flask.g.setdefault('sessionStoreMemo',{})
+        return {}
+
+    def get(self,keyname,sessionID):
+        return self.getMany([keyname],sessionID)[keyname]
+
+    def getMany(self,keynames,sessionID):
+        memo = self.requestMemo()
+        keys = {keyname:self.key(keyname,sessionID) for keyname in keynames}
+        missing = [keyname for keyname in keynames if keys[keyname] not in memo]
+
+        if missing:
+            pipeline = self.client.pipeline(transaction=False)
+            pipeline.mget([self.versionKey(keys[keyname]) for keyname in missing])
+            for keyname in missing:
+                pipeline.expire(keys[keyname],self.ttl)
+                pipeline.expire(self.versionKey(keys[keyname]),self.ttl)
+            pipeline.expire(self.sizesKey(sessionID),self.ttl)
+            pipeline.zadd(sessionSeenKey,{sessionID:time.time()})
+            self.l1.flushStats(pipeline)
+            versions = dict(zip(missing,pipeline.execute()[0]))
+
+            stale = []
+            for keyname in missing:
+                hit, value = self.l1.get(keys[keyname],versions[keyname])
+                if hit:
+                    memo[keys[keyname]] = value
+                else:
+                    stale.append(keyname)
+
+            if stale:
+                payloads = self.client.mget([keys[keyname] for keyname in stale])
+                for keyname, payload in zip(stale,payloads):
+                    memo[keys[keyname]] = decode(payload)
+                    if payload is not None:
+                        self.l1.put(keys[keyname],versions[keyname],memo[keys[keyname]],len(payload))
+
+        return {keyname:memo[keys[keyname]] for keyname in keynames}
+
+    def set(self,keyname,value,sessionID,guard=None):
+        return self.setMany({keyname:value},sessionID,guard)
+
+    def setMany(self,values,sessionID,guard=None):
+        # guard=(key, value): write only while that Redis key still holds value (checked under WATCH, so nothing that changes it in
+        # between can be overwritten).  Returns False when the guard fails.
+        memo = self.requestMemo()
+        payloads = {keyname:encode(value) for keyname, value in values.items()}
+
+        # The session's key sizes are read under WATCH too: a concurrent write to the same session retries, so the byte counts it
+        # writes back are never computed from sizes that have since changed.
+        while True:
+            with self.client.pipeline(transaction=True) as pipeline:
+                watched = [self.sizesKey(sessionID)] + ([guard[0]] if guard is not None else [])
+                pipeline.watch(*watched)
+                if guard is not None and pipeline.get(guard[0]) != guard[1]:
+                    return False
+
+                sizes = {keyname.decode():int(size) for keyname, size in pipeline.hgetall(self.sizesKey(sessionID)).items()}
+                previousTotal = sum(sizes.values())
+                sizes.update({keyname:len(payload) for keyname, payload in payloads.items()})
+
+                # Over budget: drop this session's largest other keys first.  They are caches the callbacks recompute.
+                evicted = []
+                for keyname in sorted(set(sizes)-set(payloads),key=sizes.get,reverse=True):
+                    if sum(sizes.values()) <= self.byteBudget:
+                        break
+                    evicted.append(keyname)
+                    del sizes[keyname]
+                total = sum(sizes.values())
+                lastVersion = self.client.incrby(versionSequenceKey,len(payloads))
+                versions = dict(zip(payloads,range(lastVersion-len(payloads)+1,lastVersion+1)))
+
+                pipeline.multi()
+                for keyname, payload in payloads.items():
+                    key = self.key(keyname,sessionID)
+                    pipeline.set(key,payload,ex=self.ttl)
+                    pipeline.set(self.versionKey(key),versions[keyname],ex=self.ttl)
+                for keyname in evicted:
+                    key = self.key(keyname,sessionID)
+                    pipeline.delete(key,self.versionKey(key))
+                    pipeline.hdel(self.sizesKey(sessionID),keyname)
+                pipeline.hset(self.sizesKey(sessionID),mapping={keyname:len(payload) for keyname, payload in payloads.items()})
+                pipeline.expire(self.sizesKey(sessionID),self.ttl)
+                pipeline.incrby(totalBytesKey,total-previousTotal)
+                pipeline.zadd(sessionBytesKey,{sessionID:total})
+                pipeline.zadd(sessionSeenKey,{sessionID:time.time()})
+                try:
+                    pipeline.execute()
+                    break
+                except redis.WatchError:
+                    continue
+
+        if total > self.byteBudget:
+            logging.warning('Session %s holds %d bytes, over its %d byte budget',sessionID,total,self.byteBudget)
+
+        for keyname in evicted:
+            key = self.key(keyname,sessionID)
+            memo.pop(key,None)
+            self.l1.discard(key)
+
+        for keyname, payload in payloads.items():
+            memo[self.key(keyname,sessionID)] = values[keyname]
+            self.l1.put(self.key(keyname,sessionID),str(versions[keyname]).encode(),values[keyname],len(payload))
+        return True
+
+    #*****************************************************************************************************************************************
+    # Reporting and reaping
+    #*****************************************************************************************************************************************
+
+    def report(self,top=10):
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.get(totalBytesKey)
+        pipeline.zcard(sessionSeenKey)
+        pipeline.zrevrange(sessionBytesKey,0,top-1,withscores=True)
+        pipeline.zrange(sessionSeenKey,0,top-1,withscores=True)
+        pipeline.hgetall(l1StatsKey)
+        totalBytes, sessions, largest, oldest, l1Stats = pipeline.execute()
+
+        return {'totalBytes':int(totalBytes or 0),
+                'sessions':sessions,
+                'largest':[(sessionID.decode(),int(size)) for sessionID, size in largest],
+                'oldest':[(sessionID.decode(),seen) for sessionID, seen in oldest],
+                'l1':{field.decode():int(count) for field, count in l1Stats.items()}}
+
+    def reap(self,now=None):
+        cutoff = (time.time() if now is None else now) - self.ttl
+        expired = self.client.zrangebyscore(sessionSeenKey,'-inf',cutoff)
+        if not expired:
+            return 0, 0
+
+        pipeline = self.client.pipeline(transaction=False)
+        for sessionID in expired:
+            pipeline.zscore(sessionBytesKey,sessionID)
+        reclaimed = int(sum(size or 0 for size in pipeline.execute()))
+
+        pipeline = self.client.pipeline(transaction=True)
+        for sessionID in expired:
+            pipeline.delete(self.sizesKey(sessionID.decode()))
+        pipeline.zrem(sessionBytesKey,*expired)
+        pipeline.zrem(sessionSeenKey,*expired)
+        pipeline.decrby(totalBytesKey,reclaimed)
+        pipeline.execute()
+        return len(expired), reclaimed
+
+
+sessionCache = SessionStore(connectRedis())
@@ -0,0 +1,149 @@
+#*********************************************************************************************************************************************
+# Uniform lat/lon grid over station coordinates, built once at inventory load.
+#
+# Stations are sorted by cell id (row major, row = latitude band), so every latitude band of a bounding box is one contiguous slice of
+# the sorted order.  Queries return sorted station table indices.  Longitudes are handled modulo 360 so viewports and lasso polygons
+# that cross the antimeridian work.  clusterStations / queryCells aggregate stations into coarser cells for the zoomed out map and map a
+# selected cluster back to its stations.
+#*********************************************************************************************************************************************
+import math
+
+import numpy as np
+
+
+def splitLongitudes(west,east):
+    if east < west:
+        east = east + 360
+    if east - west >= 360:
+        return [(-180.0,180.0)]
+
+    width = east - west
+    west = ((west + 180) % 360) - 180
+    east = west + width
+    if east <= 180:
+        return [(west,east)]
+    return [(west,180.0),(-180.0,east-360)]
+
+
+def viewportFromCoordinates(coordinates):
+    # mapbox._derived.coordinates are the [lon, lat] corners: top left, top right, bottom right, bottom left.
+    corners = np.asarray(coordinates,dtype=np.float64)
+    west = corners[0][0]
+    east = corners[1][0]
+    if east < west:
+        east = east + 360
+    return west, corners[:,1].min(), east, corners[:,1].max()
+
+
+def lassoPolygon(relayoutData,selectedData):
+    for source in (selectedData,relayoutData):
+        if source is not None and source.get('lassoPoints'):
+            polygon = source['lassoPoints'].get('mapbox')
+            if polygon is not None and len(polygon) >= 3:
+                return polygon
+    return None
+
+
+def clusterCells(latitude,longitude,cellSize):
+    rows = np.clip(np.floor((np.asarray(latitude,dtype=np.float64) + 90) / cellSize),0,math.ceil(180 / cellSize)-1)
+    columns = np.clip(np.floor((np.asarray(longitude,dtype=np.float64) + 180) / cellSize),0,math.ceil(360 / cellSize)-1)
+    return (rows * math.ceil(360 / cellSize) + columns).astype(np.int64)
+
+
+def clusterStations(latitude,longitude,cellSize):
+    # One point per occupied cellSize degree cell: the cell id, the mean position of its stations and how many there are.
+    cells, members, counts = np.unique(clusterCells(latitude,longitude,cellSize),return_inverse=True,return_counts=True)
+    clusterLatitude = np.bincount(members,weights=latitude,minlength=len(cells)) / counts
+    clusterLongitude = np.bincount(members,weights=longitude,minlength=len(cells)) / counts
+    return cells, clusterLatitude.astype(np.float32), clusterLongitude.astype(np.float32), counts
+
+
+class StationGrid:
+
+    def __init__(self,latitude,longitude,cellSize=1.0):
+        self.cellSize = cellSize
+        self.latCells = int(math.ceil(180 / cellSize))
+        self.lonCells = int(math.ceil(360 / cellSize))
+
+        cells = self.latRow(latitude) * self.lonCells + self.lonColumn(longitude)
+        self.order = np.argsort(cells,kind='stable').astype(np.int32)
+        self.cellStart = np.searchsorted(cells[self.order],np.arange(self.latCells*self.lonCells+1))
+
+        self.latitude = np.asarray(latitude,dtype=np.float32)[self.order]
+        self.longitude = np.asarray(longitude,dtype=np.float32)[self.order]
+        self.size = len(self.order)
+
+    def latRow(self,latitude):
+        return np.clip(np.floor((np.asarray(latitude) + 90) / self.cellSize),0,self.latCells-1).astype(np.int64)
+
+    def lonColumn(self,longitude):
+        return np.clip(np.floor((np.asarray(longitude) + 180) / self.cellSize),0,self.lonCells-1).astype(np.int64)
+
+    def candidatePositions(self,west,south,east,north):
+        firstRow, lastRow = self.latRow([south,north])
+        slices = []
+        for lonMin, lonMax in splitLongitudes(west,east):
+            firstColumn, lastColumn = self.lonColumn([lonMin,lonMax])
+            for row in range(firstRow,lastRow+1):
+                start = self.cellStart[row*self.lonCells + firstColumn]
+                stop = self.cellStart[row*self.lonCells + lastColumn + 1]
+                if stop > start:
+                    slices.append(np.arange(start,stop))
+        return np.concatenate(slices) if slices else np.empty(0,dtype=np.int64)
+
+    def queryBox(self,west,south,east,north):
+        if south <= -90 and north >= 90 and splitLongitudes(west,east) == [(-180.0,180.0)]:
+            return np.arange(self.size)
+
+        positions = self.candidatePositions(west,south,east,north)
+        latitude = self.latitude[positions]
+        longitude = self.longitude[positions]
+
+        inside = (latitude >= south) & (latitude <= north)
+        inLongitude = np.zeros(len(positions),dtype=bool)
+        for lonMin, lonMax in splitLongitudes(west,east):
+            inLongitude |= (longitude >= lonMin) & (longitude <= lonMax)
+
+        return np.sort(self.order[positions[inside & inLongitude]])
+
+    def queryPolygon(self,polygon):
+        vertices = np.asarray(polygon,dtype=np.float64)
+        lon = vertices[:,0]
+        lat = vertices[:,1]
+        west = lon.min()
+
+        positions = self.candidatePositions(west,lat.min(),lon.max(),lat.max())
+        pointLat = self.latitude[positions].astype(np.float64)
+        # Unwrap candidate longitudes into [west, west + 360) so they share the polygon's longitude frame.
+        pointLon = west + np.mod(self.longitude[positions] - west,360)
+
+        # Even-odd ray casting, vectorized over points and looped over polygon edges.
+        inside = np.zeros(len(positions),dtype=bool)
+        previous = len(vertices) - 1
+        for current in range(len(vertices)):
+            lonA, latA = lon[current], lat[current]
+            lonB, latB = lon[previous], lat[previous]
+            if latA != latB:
+                crosses = (latA > pointLat) != (latB > pointLat)
+                edgeLon = lonA + (pointLat - latA) * (lonB - lonA) / (latB - latA)
+                inside ^= crosses & (pointLon < edgeLon)
+            previous = current
+
+        return np.sort(self.order[positions[inside]])
+
+    def queryCells(self,cellSize,cells):
+        # Stations in clusterStations cells, using the same cell arithmetic so a cluster resolves to exactly its members.
+        columns = math.ceil(360 / cellSize)
+        found = []
+        for cell in cells:
+            row, column = divmod(int(cell),columns)
+            south, west = row*cellSize - 90, column*cellSize - 180
+            positions = self.candidatePositions(west,south,min(west+cellSize,180),min(south+cellSize,90))
+            inCell = clusterCells(self.latitude[positions],self.longitude[positions],cellSize) == cell
+            found.append(self.order[positions[inCell]])
+        return np.unique(np.concatenate(found)) if found else np.empty(0,dtype=np.int64)
+
+    def mask(self,indices):
+        selected = np.zeros(self.size,dtype=bool)
+        selected[indices] = True
+        return selected
@@ -0,0 +1,107 @@
+#*********************************************************************************************************************************************
+# Station level view of the inventory, built once at load time.
+#
+# One row per station (in inventory.station category order) with lat/lon and a packed bitmask of the measures it reports.  The
+# per-measure begin/end years are kept grouped by measure (station index, begin, end), so absent (station, measure) pairs cost nothing
+# and a "any of these measures in this year window" test is a handful of vectorized slices instead of a query and a dedupe.
+#*********************************************************************************************************************************************
+import numpy as np
+import pandas as pd
+
+
+class StationTable:
+
+    def __init__(self,inventory):
+        stationCodes = inventory.station.cat.codes.values.astype(np.int32)
+        measureCodes = inventory.measure.cat.codes.values.astype(np.int16)
+
+        self.stations = inventory.station.cat.categories
+        self.measures = inventory.measure.cat.categories
+        self.measureLookup = {measure:code for code, measure in enumerate(self.measures)}
+
+        stationCount = len(self.stations)
+        self.latitude = np.zeros(stationCount,dtype=np.float32)
+        self.longitude = np.zeros(stationCount,dtype=np.float32)
+        self.latitude[stationCodes] = inventory.latitude.values
+        self.longitude[stationCodes] = inventory.longitude.values
+
+        present = np.zeros((stationCount,len(self.measures)),dtype=bool)
+        present[stationCodes,measureCodes] = True
+        self.measureBits = np.packbits(present,axis=1,bitorder='little')
+
+        order = np.lexsort((stationCodes,measureCodes))
+        self.measureStart = np.searchsorted(measureCodes[order],np.arange(len(self.measures)+1))
+        self.measureStation = stationCodes[order]
+        self.measureBegin = inventory.begin.values[order]
+        self.measureEnd = inventory.end.values[order]
+
+    def __len__(self):
+        return len(self.stations)
+
+    def measureCodes(self,measures):
+        return sorted({self.measureLookup[measure] for measure in measures or [] if measure in self.measureLookup})
+
+    def measureMask(self,measures):
+        mask = np.zeros(self.measureBits.shape[1],dtype=np.uint8)
+        for code in self.measureCodes(measures):
+            mask[code // 8] |= np.uint8(1 << (code % 8))
+        return mask
+
+    def hasAnyMeasure(self,measures):
+        return (self.measureBits & self.measureMask(measures)).any(axis=1)
+
+    def select(self,measures,yearRange=None,rangeMode='in'):
+        if yearRange is None or None in yearRange:
+            return self.hasAnyMeasure(measures)
+
+        yearBegin, yearEnd = yearRange
+        selected = np.zeros(len(self),dtype=bool)
+
+        for code in self.measureCodes(measures):
+            rows = slice(self.measureStart[code],self.measureStart[code+1])
+            begin = self.measureBegin[rows]
+            end = self.measureEnd[rows]
+
+            if rangeMode == 'in':
+                inRange = (begin <= yearBegin) & (end >= yearEnd)
+            elif rangeMode == 'out':
+                inRange = (begin >= yearBegin) & (end <= yearEnd)
+            else:
+                inRange = (begin == yearBegin) & (end == yearEnd)
+
+            selected[self.measureStation[rows][inRange]] = True
+
+        return selected
+
+    def activity(self,stationIndices,measures):
+        # One row per (station, measure) pair the inventory has among the given stations and measures: the station's position in
+        # stationIndices, the measure's position in measures, and the pair's begin / end years.
+        position = np.full(len(self),-1,dtype=np.int32)
+        position[stationIndices] = np.arange(len(stationIndices),dtype=np.int32)
+
+        columns = []
+        for measurePosition, measure in enumerate(measures):
+            code = self.measureLookup.get(measure)
+            if code is None:
+                continue
+            rows = slice(self.measureStart[code],self.measureStart[code+1])
+            stationPosition = position[self.measureStation[rows]]
+            keep = stationPosition >= 0
+            columns.append((stationPosition[keep],np.full(keep.sum(),measurePosition,dtype=np.int32),
+                            self.measureBegin[rows][keep],self.measureEnd[rows][keep]))
+
+        if not columns:
+            return [np.zeros(0,dtype=np.int32)]*2 + [np.zeros(0,dtype=self.measureBegin.dtype)]*2
+        return [np.concatenate(column) for column in zip(*columns)]
+
+    def frame(self,selected=None):
+        if selected is None:
+            index = np.arange(len(self))
+        elif selected.dtype == bool:
+            index = np.flatnonzero(selected)
+        else:
+            index = selected
+
+        return pd.DataFrame({'station':pd.Categorical.from_codes(index,categories=self.stations),
+                             'latitude':self.latitude[index],
+                             'longitude':self.longitude[index]})
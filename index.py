@@ -1,3 +1,5 @@
+import os
+
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
@@ -28,11 +30,6 @@ yearSlider = dcc.RangeSlider(id='yearSlider')
 yearRange = html.Div(id='yearRange')
 
 sessionGenDiv = html.Div(id='sessionGenDiv',style = {'display':'none'})  
-dataProcessMapBox = html.Div(id='dataProcessMapBox',style = {'display':'none'})
-dataProcessMeasure = html.Div(id='dataProcessMeasure',style = {'display':'none'})
-dataProcessDownloadData = html.Div(id='dataProcessDownloadData',style = {'display':'none'})
-dataProcessMeasureValue = html.Div(id='dataProcessMeasureValue',style = {'display':'none'})
-dataProcessYearSlider = html.Div(id='dataProcessYearSlider',style = {'display':'none'})
 fixFilter = dcc.RadioItems(id='fixFilter',options = [{'label':'Lock Stations     ','value':'Mapbox'},
                                                     {'label':'Lock Elements     ','value':'Measures'},
                                                     {'label':'Lock Years     ','value':'Time'}],
@@ -47,20 +44,31 @@ dateRangeInsideOutside = dcc.RadioItems(id='dateRangeInsideOutside',options=[{'l
 sessionStore = dcc.Store(id='sessionStore')
 measureValueStore = dcc.Store(id='measureValueStore')
 mapboxCenterStore = dcc.Store(id='mapboxCenterStore')
+# The map's inputs with a request number taken in the browser, in the order they changed (assets/mapRequest.js).
+mapRequest = dcc.Store(id='mapRequest')
 
 
 downloadDataButton = html.Button('Download Filtered Data To Private AWS S3 Bucket',id='downloadDataButton',n_clicks=0)
 startDownloadButton = html.Button('Download',id='startDownloadButton',n_clicks=0)
+cancelDownloadButton = html.Button('Cancel',id='cancelDownloadButton',n_clicks=0)
 
 downloadSpinner = dcc.Loading(id='downloadSpinner',type = 'default',children=[html.Div(id = 'downloadSpinnerOutput')])
 progressPercent = html.Div(id='progressPercent')
-progressInterval = dcc.Interval(id='progressInterval')
+# progressInterval only re-renders pushed progress in the browser; progressFallbackInterval polls the server while no stream is live.
+progressInterval = dcc.Interval(id='progressInterval',interval=500,disabled=True)
+progressFallbackInterval = dcc.Interval(id='progressFallbackInterval',interval=int(os.environ.get('ProgressFallbackSeconds',5))*1000,
+                                        disabled=True)
+progressFallback = dcc.Store(id='progressFallback')
 downloadCSV = html.A('Download csv',id='downloadCSV')
-progressDivInput = html.Div(id='progressDivInput',hidden=True)
+downloadCSVGzip = html.A('Download csv.gz',id='downloadCSVGzip')
 inputAwsBucket = dcc.Input(id='inputAwsBucket',placeholder = 'AWS Bucket Name')
 inputAwsObject = dcc.Input(id='inputAwsObject',placeholder = 'AWS Object Name')
 inputAwsKey = dcc.Input(id='inputAwsKey',placeholder = 'AWS Key',type = 'password',size='40')
 inputAwsSecretKey = dcc.Input(id='inputAwsSecretKey',placeholder = 'AWS Secret Key',type = 'password',size='40')
+exportFormat = dcc.RadioItems(id='exportFormat',options=[{'label':'CSV     ','value':'csv'},
+                                                        {'label':'Gzip CSV     ','value':'csv.gz'},
+                                                        {'label':'Parquet     ','value':'parquet'}],
+                                                        value='csv')
 
 def get_layout():
     return html.Div([
@@ -101,7 +109,9 @@ def get_layout():
             ),
             html.Div([
                     html.Div(className='col-2'),
-                    html.Div([downloadDataButton],className='col-8',style={'text-align':'center','padding-top':'30px'}),
+                    html.Div([downloadDataButton,
+                              html.Div([downloadCSV,' | ',downloadCSVGzip],style={'padding-top':'10px'})],
+                              className='col-8',style={'text-align':'center','padding-top':'30px'}),
                     html.Div(className='col-2')
                 ],className='row'),
         
@@ -110,27 +120,25 @@ def get_layout():
                 html.Div(
                 html.Div([
                     html.Div([html.Div(['Enter private AWS s3 information'],className='h5'),
-                    html.Div(['Your information will never be collected or stored.  Information entered here will not outlast the browser session.'],style={'font-style':'italic'})
+                    html.Div(['Your information will never be collected.  It is held only until your export finishes and will not outlast the browser session.'],style={'font-style':'italic'})
                     ],className='card-title'),
                 html.Div([inputAwsBucket, inputAwsObject],className='card-body'),
                 html.Div([inputAwsKey, inputAwsSecretKey],className='card-body'),
+                html.Div([exportFormat],className='card-body'),
                 html.Div([html.Div(children = [downloadSpinner]),progressPercent],className='card-body'),
-                html.Div([startDownloadButton],className='card-footer',style={'text-align':'center'})
+                html.Div([startDownloadButton,cancelDownloadButton],className='card-footer',style={'text-align':'center'})
                 ],className = 'card'                
                 ),className='col-8',style={'text-align':'center'}),                
                 html.Div(className='col-2')
                 ],className = 'row',id='downloadDataDiv'),
         html.Div([html.A('Merrillmount Consulting',href='http://merrillmount.com/',target='_blank')],style = {'padding-top':'30px'}),
-        progressDivInput,
         sessionStore,
         sessionGenDiv,
-        dataProcessMapBox,
-        dataProcessMeasure,
-        dataProcessMeasureValue,
-        dataProcessYearSlider,
-        dataProcessDownloadData,
         mapboxCenterStore,
-        progressInterval
+        mapRequest,
+        progressFallback,
+        progressInterval,
+        progressFallbackInterval
     ])
 
 app.layout = get_layout